@@ -1,6 +1,30 @@
 import pygame
+import argparse
+import atexit
+import cProfile
+import json
+import math
+import multiprocessing
 import os
+import pstats
+import queue
+import random
+import socket
+import sqlite3
+import struct
+import sys
+import threading
 import time
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 pygame.init()
 
@@ -9,9 +33,75 @@ screen_info = pygame.display.Info()
 MAX_WIDTH = 1600
 MAX_HEIGHT = 900
 # Define the size of the *visible window*, not the entire game world
-WIDTH = min(screen_info.current_w - 100, MAX_WIDTH)
-HEIGHT = min(screen_info.current_h - 100, MAX_HEIGHT)
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
+WINDOW_WIDTH = min(screen_info.current_w - 100, MAX_WIDTH)
+WINDOW_HEIGHT = min(screen_info.current_h - 100, MAX_HEIGHT)
+
+# Internal render target. Everything is drawn into `screen` at WIDTH x HEIGHT
+# and scaled up to the window in present().
+# RENDER_SCALE is the fraction of the window resolution used for rendering,
+# UPSCALE_MODE is "integer" (whole-number pixel scaling, the default), "smooth"
+# (any scale, filtered) or "scaled" (pygame.SCALED, the scaling is done by SDL).
+# smoothscale to 1600x900 costs 6-8 ms a frame, more than a full-resolution frame
+# saves, so it is only there for looks.
+RENDER_SCALE = float(os.environ.get("MAZEQUEST_RENDER_SCALE", "1.0"))
+UPSCALE_MODE = os.environ.get("MAZEQUEST_UPSCALE", "integer")
+
+window = None
+screen = None
+upscale_target = None # Part of the window the render surface is scaled into
+WIDTH = WINDOW_WIDTH
+HEIGHT = WINDOW_HEIGHT
+
+
+def setup_display(render_scale=RENDER_SCALE, upscale_mode=UPSCALE_MODE):
+    """Creates the window and the internal render surface for the given render scale."""
+    global window, screen, upscale_target, WIDTH, HEIGHT, RENDER_SCALE, UPSCALE_MODE
+
+    render_scale = max(0.1, min(1.0, render_scale))
+
+    if upscale_mode == "integer":
+        factor = max(1, round(1 / render_scale))
+        WIDTH = WINDOW_WIDTH // factor
+        HEIGHT = WINDOW_HEIGHT // factor
+        if window is None or window.get_size() != (WINDOW_WIDTH, WINDOW_HEIGHT):
+            window = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+        # Scaled into an exact multiple of the render surface so every pixel maps to factor x factor,
+        # the window keeps its size when the factor changes
+        upscale_target = window.subsurface((0, 0, WIDTH * factor, HEIGHT * factor))
+        screen = pygame.Surface((WIDTH, HEIGHT)) if factor > 1 else window
+        render_scale = 1 / factor
+    elif upscale_mode == "scaled":
+        WIDTH = int(WINDOW_WIDTH * render_scale)
+        HEIGHT = int(WINDOW_HEIGHT * render_scale)
+        window = pygame.display.set_mode((WIDTH, HEIGHT), pygame.SCALED)
+        screen = window
+    else:
+        upscale_mode = "smooth"
+        WIDTH = int(WINDOW_WIDTH * render_scale)
+        HEIGHT = int(WINDOW_HEIGHT * render_scale)
+        if window is None or window.get_size() != (WINDOW_WIDTH, WINDOW_HEIGHT):
+            window = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+        screen = pygame.Surface((WIDTH, HEIGHT)) if render_scale < 1.0 else window
+        upscale_target = window
+
+    RENDER_SCALE = render_scale
+    UPSCALE_MODE = upscale_mode
+    return screen
+
+
+def present():
+    """Scales the internal render surface up to the window and flips the display."""
+    if screen is not window:
+        if UPSCALE_MODE == "integer":
+            pygame.transform.scale(screen, upscale_target.get_size(), upscale_target)
+        else:
+            pygame.transform.smoothscale(screen, upscale_target.get_size(), upscale_target)
+    pygame.display.flip()
+    if frame_capture is not None:
+        frame_capture.grab(screen)
+
+
+setup_display()
 pygame.display.set_caption("MazeQuest")
 
  
@@ -24,6 +114,7 @@ YELLOW = (255, 255, 0) # Finish line
 GRAY = (100, 100, 100) # Platform color
 SKY_BLUE = (135, 206, 235) # Background sky
 PURPLE = (128, 0, 128) # Moving hazard platform
+BROWN = (139, 69, 19) # Timed door
 
 
 menu_font = pygame.font.SysFont(None, 48)
@@ -38,16 +129,274 @@ GAME_STATE_LEVEL_COMPLETE = 3
 GAME_STATE_GAME_OVER = 4 
 GAME_STATE_VICTORY = 5 
 
+# Level editor tiles: (tile character, name, key that selects it)
+EDITOR_PALETTE = [
+    ('#', "Platform", pygame.K_1),
+    ('L', "Hazard", pygame.K_2),
+    ('M', "Moving hazard", pygame.K_3),
+    ('F', "Finish", pygame.K_4),
+    ('1', "Player 1 start", pygame.K_5),
+    ('2', "Player 2 start", pygame.K_6),
+    ('_', "Empty", pygame.K_7),
+    ('D', "Timed door", pygame.K_8),
+]
+EDITOR_SCROLL_SPEED = 15 # px per frame
+
+# Key bindings per local player: (left, right, jump). Their count is the number of local players.
+PLAYER_KEY_BINDINGS = [
+    (pygame.K_a, pygame.K_d, pygame.K_w),
+    (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP),
+    (pygame.K_j, pygame.K_l, pygame.K_i),
+    (pygame.K_f, pygame.K_h, pygame.K_t),
+    (pygame.K_KP4, pygame.K_KP6, pygame.K_KP8),
+    (pygame.K_z, pygame.K_c, pygame.K_x),
+    (pygame.K_v, pygame.K_n, pygame.K_b),
+    (pygame.K_KP1, pygame.K_KP3, pygame.K_KP5),
+]
+MAX_BOTS = 500
+
+# Level map characters of the player spawn points, player 1 to 9, and all unique markers
+SPAWN_MARKERS = "123456789"
+MARKERS = SPAWN_MARKERS + "F"
+
+# Game.get_state() layout: a flat tuple of ints used by snapshots and network co-op
+GAME_STATE_HEADER = 6       # game_state, level_index, retries_left, timer in ms, level tick, ticks to the pending respawn (0: none)
+GAME_STATE_PLAYER_FIELDS = 7 # x, sub_y, y_velocity, on_ground, is_dead, sprite_key, finish time in ms, per player
+
 #Game Physics Constants
-GRAVITY = 0.5 
-JUMP_STRENGTH = -15
+# Physics runs on integers only: vertical position and velocity are in sub-pixels (1/256 px), and
+# rect.y is derived from the position with a floor shift. The same inputs give the same states,
+# bit for bit, on every machine, which replays, snapshots and network co-op rely on.
+SUBPIXEL_BITS = 8
+SUBPIXELS = 1 << SUBPIXEL_BITS
+SUBPIXEL_MASK = SUBPIXELS - 1
+GRAVITY = SUBPIXELS // 2            # 0.5 px per frame per frame
+JUMP_STRENGTH = -15 * SUBPIXELS
+MAX_FALL_SPEED = 10 * SUBPIXELS
+
+
+# Event Log
+# Game events are frame-tagged records in a ring buffer. A background thread drains the buffer to
+# a JSON-lines file (and echoes the important ones to the console), so emitting never touches stdout.
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+EVENT_LOG_PATH = os.environ.get("MAZEQUEST_EVENT_LOG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "events.jsonl"))
+EVENT_LOG_LEVEL = os.environ.get("MAZEQUEST_LOG_LEVEL", "info")
+EVENT_LOG_CONSOLE_LEVEL = os.environ.get("MAZEQUEST_CONSOLE_LOG_LEVEL", "warning")
+EVENT_LOG_CAPACITY = 4096      # Records kept while the writer is behind, the oldest are dropped first
+EVENT_LOG_FLUSH_INTERVAL = 0.2 # Seconds between drains
+
+
+class EventLog:
+    def __init__(self, path=EVENT_LOG_PATH, level=EVENT_LOG_LEVEL, console_level=EVENT_LOG_CONSOLE_LEVEL, capacity=EVENT_LOG_CAPACITY):
+        self.path = path
+        self.min_level = LOG_LEVELS[level]
+        self.console_level = LOG_LEVELS[console_level]
+        self.records = deque(maxlen=capacity)
+        self.dropped = 0
+        self.frame = 0 # Set by the game loop, every record is tagged with it
+        self.stopped = threading.Event()
+        self.writer = None
+
+    def emit(self, level, event, /, **fields):
+        """Queues an event. Never blocks: a full buffer drops its oldest record."""
+        if LOG_LEVELS[level] < self.min_level:
+            return
+        if self.writer is None:
+            self._start()
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append((self.frame, time.time(), level, event, fields))
+
+    def debug(self, event, /, **fields):
+        self.emit("debug", event, **fields)
+
+    def info(self, event, /, **fields):
+        self.emit("info", event, **fields)
+
+    def warning(self, event, /, **fields):
+        self.emit("warning", event, **fields)
+
+    def error(self, event, /, **fields):
+        self.emit("error", event, **fields)
+
+    def _start(self):
+        self.writer = threading.Thread(target=self._write_loop, name="event-log-writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def _drain(self, log_file):
+        lines = []
+        while self.records:
+            frame, timestamp, level, event, fields = self.records.popleft()
+            lines.append(json.dumps({"frame": frame, "time": round(timestamp, 6), "severity": level, "event": event, **fields}, default=str))
+            if LOG_LEVELS[level] >= self.console_level:
+                print(f"[{level.upper()}] {event}: " + ", ".join(f"{key}={value}" for key, value in fields.items()))
+        if lines:
+            log_file.write("\n".join(lines) + "\n")
+            log_file.flush()
+
+    def _write_loop(self):
+        with open(self.path, "a", encoding="utf-8") as log_file:
+            while not self.stopped.wait(EVENT_LOG_FLUSH_INTERVAL):
+                self._drain(log_file)
+            self._drain(log_file)
+
+    def close(self):
+        """Writes the remaining records and stops the writer thread."""
+        if self.writer is not None:
+            self.stopped.set()
+            self.writer.join(timeout=5)
+
+
+event_log = EventLog()
+
+
+# Frame Capture
+# Every presented frame is copied into one of a fixed ring of surfaces and encoded to disk by worker
+# threads. The game never waits for them: when no slot is free, the frame is dropped and counted.
+CAPTURE_FORMATS = ("png", "raw") # PNG sequence, or one stream of raw RGB24 frames (e.g. for ffmpeg -f rawvideo)
+CAPTURE_RING_SIZE = 8
+CAPTURE_WORKERS = 2
+CAPTURE_PNG_COMPRESSION = 1 # zlib level, encoding speed matters more than file size here
+CAPTURE_RGB_MASKS = (0xFF, 0xFF00, 0xFF0000, 0) # 24-bit slots with their bytes in R, G, B order, as PNG and rgb24 want them
+
+
+def encode_png(width, height, rgb):
+    """A PNG file of 8-bit RGB pixels. zlib releases the GIL while it compresses, so workers run beside the game."""
+    stride = width * 3
+    rows = memoryview(rgb)
+    scanlines = b"".join(b"\x00" + rows[y * stride:(y + 1) * stride] for y in range(height)) # Filter type 0 per row
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(scanlines, CAPTURE_PNG_COMPRESSION)) + chunk(b"IEND", b""))
+
+
+class FrameCapture:
+    def __init__(self, directory, size, fps, capture_format="png", ring_size=CAPTURE_RING_SIZE, workers=CAPTURE_WORKERS):
+        self.directory = directory
+        self.size = size
+        self.fps = fps
+        self.format = capture_format
+        os.makedirs(directory, exist_ok=True)
+        self.slots = [pygame.Surface(size, 0, 24, CAPTURE_RGB_MASKS) for _ in range(ring_size)]
+        self.packed = self.slots[0].get_pitch() == size[0] * 3 # Rows without padding can be copied out as they are
+        self.free_slots = deque(range(ring_size)) # Only the game thread takes slots, workers give them back
+        self.pending = queue.SimpleQueue()         # (slot, frame number), None stops a worker
+        self.frame = 0
+        self.captured = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.stream = None
+        if capture_format == "raw":
+            self.stream = open(os.path.join(directory, "frames.rgb24"), "wb")
+            # One writer takes the frames off the queue in order and appends them, there is nothing to encode
+            workers = 1
+        self.workers = [threading.Thread(target=self._encode_loop, name=f"frame-capture-{i}", daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        atexit.register(self.close)
+
+    def grab(self, surface):
+        """Copies the frame into a free slot and queues it. Never blocks."""
+        self.frame += 1
+        if not self.free_slots:
+            self.dropped += 1
+            return
+        slot = self.free_slots.popleft()
+        self.slots[slot].blit(surface, (0, 0))
+        self.pending.put((slot, self.frame))
+        self.captured += 1
+
+    def _encode_loop(self):
+        width, height = self.size
+        while True:
+            job = self.pending.get()
+            if job is None:
+                return
+            slot, frame = job
+            try:
+                if self.packed:
+                    rgb = self.slots[slot].get_buffer().raw # A plain copy, tobytes() would hold the GIL while converting
+                else:
+                    rgb = pygame.image.tobytes(self.slots[slot], "RGB")
+                self.free_slots.append(slot)
+                slot = None
+                if self.stream is not None:
+                    self.stream.write(rgb)
+                else:
+                    with open(os.path.join(self.directory, f"frame_{frame:06d}.png"), "wb") as png_file:
+                        png_file.write(encode_png(width, height, rgb))
+                self.written += 1
+            except Exception as error:
+                # A full disk or a vanished directory costs this frame, not the worker
+                self.failed += 1
+                event_log.error("capture_write_failed", frame=frame, error=repr(error))
+            finally:
+                if slot is not None:
+                    self.free_slots.append(slot)
+
+    def close(self):
+        """Waits for the queued frames, then writes capture.json with what is needed to play them back."""
+        if not self.workers:
+            return
+        for _ in self.workers:
+            self.pending.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        if self.stream is not None:
+            self.stream.close()
+        with open(os.path.join(self.directory, "capture.json"), "w", encoding="utf-8") as info_file:
+            json.dump({"format": self.format, "width": self.size[0], "height": self.size[1], "fps": self.fps,
+                       "frames": self.frame, "written": self.written, "dropped": self.dropped, "failed": self.failed}, info_file)
+        print(f"Capture: {self.written} frames written to {self.directory}, {self.dropped} of {self.frame} dropped"
+              + (f", {self.failed} failed to write" if self.failed else ""))
+
+
+frame_capture = None # Set by --capture
+
 
+_character_sprites_cache = {}
 
 def load_character_sprites(character_type_folder_name, skin, scale_factor=3):
+    """Loads the sprites of one skin once, characters with the same skin share them."""
+    cache_key = (character_type_folder_name, skin, scale_factor)
+    if cache_key not in _character_sprites_cache:
+        sprites = _load_character_sprites(character_type_folder_name, skin, scale_factor)
+        for sprite in sprites.values():
+            get_sprite_mask(sprite)
+        _character_sprites_cache[cache_key] = sprites
+    return _character_sprites_cache[cache_key]
+
+
+_sprite_masks = {}
+_filled_masks = {}
+
+def get_sprite_mask(surface):
+    """Collision mask of the visible pixels of a sprite, computed once per surface."""
+    mask = _sprite_masks.get(surface)
+    if mask is None:
+        mask = _sprite_masks[surface] = pygame.mask.from_surface(surface)
+    return mask
+
+
+def get_filled_mask(width, height):
+    """Mask of a solid tile, shared by all tiles of the same size."""
+    mask = _filled_masks.get((width, height))
+    if mask is None:
+        mask = _filled_masks[(width, height)] = pygame.mask.Mask((width, height), fill=True)
+    return mask
+
+
+def _load_character_sprites(character_type_folder_name, skin, scale_factor):
     base_path = os.path.join(os.path.dirname(__file__), f"{character_type_folder_name}_{skin}")
     
     if not os.path.exists(base_path):
-        print(f"Error: Character sprite folder not found at '{base_path}'. Make sure folder names are correct and directly in the script's directory.")
+        event_log.error("sprite_folder_missing", path=base_path)
         default_sprite_size = int(24 * scale_factor) 
         default_sprite = pygame.Surface([default_sprite_size, default_sprite_size], pygame.SRCALPHA)
         placeholder_color = RED if character_type_folder_name == "Male" else BLUE 
@@ -89,10 +438,10 @@ def load_character_sprites(character_type_folder_name, skin, scale_factor=3):
 
                 sprites[action_suffix] = pygame.transform.scale(image, (new_width, new_height))
             except FileNotFoundError:
-                print(f"Warning: Sprite not found at {image_path}. Using placeholder for {action_suffix}.")
+                event_log.warning("sprite_missing", path=image_path, frame_key=action_suffix)
                 sprites[action_suffix] = default_sprite_for_frame
             except pygame.error as e:
-                print(f"Error loading image {image_path}: {e}. Using placeholder.")
+                event_log.error("sprite_load_failed", path=image_path, error=str(e))
                 sprites[action_suffix] = default_sprite_for_frame
     
     if "DownP" not in sprites: 
@@ -109,6 +458,16 @@ class Camera:
         self.height = height
         self.level_width = level_width 
         self.level_height = level_height 
+        self.view_rect = pygame.Rect(0, 0, 0, 0) # Reused by project()
+
+    def set_level_dimensions(self, level_width, level_height):
+        self.level_width = level_width
+        self.level_height = level_height
+
+    def set_view_size(self, width, height):
+        self.width = width
+        self.height = height
+        self.camera.size = (width, height)
 
     def apply(self, entity):
         return entity.rect.move(self.camera.topleft)
@@ -116,13 +475,37 @@ class Camera:
     def apply_rect(self, rect):
         return rect.move(self.camera.topleft)
 
+    def project(self, rect):
+        """Screen position of a world rect in the camera's reused view rect, valid until the next call."""
+        view_rect = self.view_rect
+        view_rect.update(rect)
+        view_rect.move_ip(self.camera.x, self.camera.y)
+        return view_rect
+
     def update(self, target_rects):
         if not target_rects:
             return
 
         avg_x = sum(r.centerx for r in target_rects) // len(target_rects)
         avg_y = sum(r.centery for r in target_rects) // len(target_rects)
-
+        self.center_on(avg_x, avg_y)
+
+    def follow(self, characters, first=None):
+        """update() for the characters that are still alive, without building a list of their rects.
+        With `first`, only the first that many characters are followed."""
+        total_x = total_y = count = 0
+        for i, character in enumerate(characters):
+            if i == first:
+                break
+            if not character.is_dead:
+                rect = character.rect
+                total_x += rect.centerx
+                total_y += rect.centery
+                count += 1
+        if count:
+            self.center_on(total_x // count, total_y // count)
+
+    def center_on(self, avg_x, avg_y):
         x = -avg_x + int(self.width / 2)
         y = -avg_y + int(self.height / 2)
 
@@ -131,114 +514,315 @@ class Camera:
         y = min(0, y) 
         y = max(-(self.level_height - self.height), y) 
 
-        self.camera = pygame.Rect(x, y, self.width, self.height)
-
+        self.camera.x = x
+        self.camera.y = y
+
+
+
+# Sprite keys stored per entity as a small index into this tuple
+SPRITE_KEYS = ("DownP", "DownR", "RightP", "RightR", "LeftP", "LeftR", "ForwardP", "ForwardR")
+SPRITE_KEY_INDEX = {key: i for i, key in enumerate(SPRITE_KEYS)}
+# Direction indices, matching the order of SPRITE_KEYS (sprite key index = direction * 2 + moving)
+DIRECTIONS = ("Down", "Right", "Left", "Forward")
+DIRECTION_INDEX = {direction: i for i, direction in enumerate(DIRECTIONS)}
+
+
+class EntityStore:
+    """Dynamic entity state in contiguous arrays. Characters and moving hazards are thin views into one slot each.
+
+    The rects are the only copy of the position in whole pixels, so a slot costs its Rect plus a few bytes per column.
+    """
+    def __init__(self, world_width=0, world_height=0):
+        self.x_velocity = array("i")
+        self.sub_y = array("i")         # y in sub-pixels, the source of rect.y for characters
+        self.y_velocity = array("i")    # Sub-pixels per frame
+        self.on_ground = array("b")
+        self.is_dead = array("b")
+        self.sprite_key = array("B")    # Also the facing direction and whether the entity walks, see SPRITE_KEYS
+        self.start_x = array("i")
+        self.start_y = array("i")
+        self.look = array("I")          # Index into looks, only used by characters
+        # Patrol bounds, only used by moving hazards
+        self.min_x = array("i")
+        self.max_x = array("i")
+        # Collision rects, the position in whole pixels
+        self.rects = []
+        # (character type, skin, sprites) shared by all characters that look the same
+        self.looks = []
+        self.look_index = {}
+        # Everything in one store lives in the same world
+        self.world_width = world_width
+        self.world_height = world_height
 
+    def __len__(self):
+        return len(self.rects)
+
+    def add(self, rect, x_velocity=0, min_x=0, max_x=0):
+        index = len(self.rects)
+        self.rects.append(rect)
+        self.sub_y.append(rect.y << SUBPIXEL_BITS)
+        self.x_velocity.append(x_velocity)
+        self.y_velocity.append(0)
+        self.on_ground.append(0)
+        self.is_dead.append(0)
+        self.sprite_key.append(0)
+        self.start_x.append(rect.x)
+        self.start_y.append(rect.y)
+        self.look.append(0)
+        self.min_x.append(min_x)
+        self.max_x.append(max_x)
+        return index
+
+    def remove(self, index):
+        """Removes a slot by moving the last slot into it. Returns the old index of the moved slot."""
+        last = len(self.rects) - 1
+        for items in (self.rects, self.sub_y, self.x_velocity, self.y_velocity, self.on_ground, self.is_dead,
+                      self.sprite_key, self.start_x, self.start_y, self.look, self.min_x, self.max_x):
+            items[index] = items[last]
+            items.pop()
+        return last
+
+    def get_look(self, character_type, skin, sprites):
+        """Index of a (character type, skin, sprites) entry in looks, added on first use."""
+        key = (character_type, skin, id(sprites))
+        index = self.look_index.get(key)
+        if index is None:
+            index = self.look_index[key] = len(self.looks)
+            self.looks.append((character_type, skin, sprites))
+        return index
+
+    def sync_position(self, index):
+        """Takes over a rect moved in whole pixels, keeping the sub-pixel fraction of y."""
+        rect = self.rects[index]
+        self.sub_y[index] = (rect.y << SUBPIXEL_BITS) | (self.sub_y[index] & SUBPIXEL_MASK)
+
+    def update_patrols(self):
+        """Moves every patrolling entity back and forth between min_x and max_x."""
+        x_velocities, min_xs, max_xs, rects = self.x_velocity, self.min_x, self.max_x, self.rects
+        for i in range(len(rects)):
+            rect = rects[i]
+            x = rect.x + x_velocities[i]
+            if x >= max_xs[i]:
+                x = max_xs[i]
+                x_velocities[i] = -abs(x_velocities[i])
+            elif x <= min_xs[i]:
+                x = min_xs[i]
+                x_velocities[i] = abs(x_velocities[i])
+            rect.x = x
+
+
+EMPTY_SURFACE = pygame.Surface((0, 0))
+
+# Tiles of the same size and colour share one surface
+_tile_surfaces = {}
+
+def get_tile_surface(width, height, color):
+    key = (width, height, color)
+    surface = _tile_surfaces.get(key)
+    if surface is None:
+        surface = pygame.Surface([width, height])
+        surface.fill(color)
+        _tile_surfaces[key] = surface
+    return surface
+
+
+class Tile:
+    __slots__ = ("image", "rect", "tile_type")
 
-class Tile(pygame.sprite.Sprite):
     def __init__(self, x, y, tile_size, color=BLACK, tile_type="platform"):
-        super().__init__()
-        self.image = pygame.Surface([tile_size, tile_size])
-        self.image.fill(color)
-        self.rect = self.image.get_rect(topleft=(x, y)) 
+        self.image = get_tile_surface(tile_size, tile_size, color)
+        self.rect = pygame.Rect(x, y, tile_size, tile_size)
         self.tile_type = tile_type
 
     def draw(self, surface, camera):
-        surface.blit(self.image, camera.apply(self))
+        surface.blit(self.image, camera.project(self.rect))
+
 
+class HazardTile:
+    __slots__ = ("image", "rect", "hazard_type")
 
-class HazardTile(pygame.sprite.Sprite):
     def __init__(self, x, y, tile_size, color_ignored, hazard_type_ignored, height_ratio=0.4): # Увеличено до 0.4
-        super().__init__()
-        self.tile_size = tile_size
-        self.hazard_height = int(tile_size * height_ratio)
-        if self.hazard_height < 5: self.hazard_height = 5 
+        hazard_height = int(tile_size * height_ratio)
+        if hazard_height < 5: hazard_height = 5 
 
-        self.image = pygame.Surface([tile_size, self.hazard_height])
-        self.image.fill(RED) # FORCE ALL STATIC HAZARDS TO BE RED
-        
-        self.rect = self.image.get_rect(topleft=(x, y + tile_size - self.hazard_height))
+        self.image = get_tile_surface(tile_size, hazard_height, RED) # FORCE ALL STATIC HAZARDS TO BE RED
+        self.rect = pygame.Rect(x, y + tile_size - hazard_height, tile_size, hazard_height)
         self.hazard_type = "lethal_static_hazard" # Generic lethal type
 
     def draw(self, surface, camera):
-        surface.blit(self.image, camera.apply(self))
+        surface.blit(self.image, camera.project(self.rect))
 
 
-class MovingHazardPlatform(pygame.sprite.Sprite):
-    def __init__(self, x, y, tile_size, color, move_range_x, speed, hazard_type="sticky_hazard"):
-        super().__init__()
-        self.tile_size = tile_size
-        self.image = pygame.Surface([tile_size, tile_size // 2]) 
-        self.image.fill(color)
-        self.rect = self.image.get_rect(topleft=(x, y + tile_size // 2)) 
+class MovingHazardPlatform:
+    __slots__ = ("store", "index", "image", "hazard_type")
 
+    def __init__(self, x, y, tile_size, color, move_range_x, speed, store, hazard_type="sticky_hazard"):
+        self.image = get_tile_surface(tile_size, tile_size // 2, color)
         self.hazard_type = hazard_type
-        self.start_x = x
-        self.end_x = x + move_range_x # The point it moves to
-        self.current_speed = speed
-        self.moving_right = True
 
-    def update(self):
-        if self.moving_right:
-            self.rect.x += self.current_speed
-            if self.rect.x >= self.end_x:
-                self.rect.x = self.end_x
-                self.moving_right = False
-        else:
-            self.rect.x -= self.current_speed
-            if self.rect.x <= self.start_x:
-                self.rect.x = self.start_x
-                self.moving_right = True
+        self.store = store
+        self.index = store.add(pygame.Rect(x, y + tile_size // 2, tile_size, tile_size // 2),
+                               x_velocity=speed, min_x=x, max_x=x + move_range_x) # Moves to x + move_range_x and back
+
+    @property
+    def rect(self):
+        return self.store.rects[self.index]
+
+    @property
+    def start_x(self):
+        return self.store.min_x[self.index]
+
+    @property
+    def end_x(self):
+        return self.store.max_x[self.index]
+
+    @property
+    def moving_right(self):
+        return self.store.x_velocity[self.index] > 0
 
     def draw(self, surface, camera):
-        surface.blit(self.image, camera.apply(self))
+        surface.blit(self.image, camera.project(self.rect))
 
 
 
-class Character(pygame.sprite.Sprite):
-    def __init__(self, character_actual_type, skin, start_x, start_y, tile_size, world_width, world_height):
-        super().__init__()
-        self.character_type_for_folder = character_actual_type 
-        self.skin = skin
-        self.sprites = load_character_sprites(character_actual_type, skin)
-        
-        self.elemental_type = "Fire" if character_actual_type == "Male" else "Water"
+class Character:
+    __slots__ = ("store", "index", "image")
+
+    speed = 5
+    jump_strength = JUMP_STRENGTH
+
+    def __init__(self, character_actual_type, skin, start_x, start_y, tile_size, world_width, world_height, store=None):
+        sprites = load_character_sprites(character_actual_type, skin)
 
-        self.image = self.sprites.get("DownP", pygame.Surface([int(tile_size * 0.8), int(tile_size * 0.8)], pygame.SRCALPHA))
+        self.image = sprites.get("DownP", pygame.Surface([int(tile_size * 0.8), int(tile_size * 0.8)], pygame.SRCALPHA))
         if self.image.get_width() == 0 or self.image.get_height() == 0: 
             self.image = pygame.Surface([int(tile_size * 0.8), int(tile_size * 0.8)], pygame.SRCALPHA)
-            pygame.draw.circle(self.image, RED if self.elemental_type == "Fire" else BLUE, (int(tile_size*0.4), int(tile_size*0.4)), int(tile_size*0.4))
+            pygame.draw.circle(self.image, RED if character_actual_type == "Male" else BLUE, (int(tile_size*0.4), int(tile_size*0.4)), int(tile_size*0.4))
 
-        self.rect = self.image.get_rect(topleft=(start_x, start_y)) # World coordinates
-        self.start_pos = (start_x, start_y) 
+        self.store = store if store is not None else EntityStore()
+        self.index = self.store.add(self.image.get_rect(topleft=(start_x, start_y))) # World coordinates, also the start
+        self.store.look[self.index] = self.store.get_look(character_actual_type, skin, sprites)
+        self.world_width = world_width
+        self.world_height = world_height
 
-        self.direction = "Down" 
-        self.moving = False 
-        self.speed = 5 
+    @property
+    def character_type_for_folder(self):
+        return self.store.looks[self.store.look[self.index]][0]
 
-        self.y_velocity = 0
-        self.on_ground = False
-        self.jump_strength = JUMP_STRENGTH
-        self.is_dead = False 
+    @property
+    def skin(self):
+        return self.store.looks[self.store.look[self.index]][1]
 
-        self.world_width = world_width
-        self.world_height = world_height
+    @property
+    def sprites(self):
+        return self.store.looks[self.store.look[self.index]][2]
+
+    @sprites.setter
+    def sprites(self, value):
+        self.store.look[self.index] = self.store.get_look(self.character_type_for_folder, self.skin, value)
+
+    @property
+    def elemental_type(self):
+        return "Fire" if self.character_type_for_folder == "Male" else "Water"
+
+    @property
+    def start_pos(self):
+        return (self.store.start_x[self.index], self.store.start_y[self.index])
+
+    @start_pos.setter
+    def start_pos(self, value):
+        self.store.start_x[self.index], self.store.start_y[self.index] = value
+
+    @property
+    def direction(self):
+        return DIRECTIONS[self.store.sprite_key[self.index] >> 1]
+
+    @direction.setter
+    def direction(self, value):
+        sprite_key = self.store.sprite_key
+        sprite_key[self.index] = DIRECTION_INDEX[value] << 1 | (sprite_key[self.index] & 1)
+
+    @property
+    def moving(self):
+        return bool(self.store.sprite_key[self.index] & 1)
+
+    @moving.setter
+    def moving(self, value):
+        sprite_key = self.store.sprite_key
+        sprite_key[self.index] = (sprite_key[self.index] & ~1) | bool(value)
 
+    @property
+    def world_width(self):
+        return self.store.world_width
+
+    @world_width.setter
+    def world_width(self, value):
+        self.store.world_width = value
+
+    @property
+    def world_height(self):
+        return self.store.world_height
+
+    @world_height.setter
+    def world_height(self, value):
+        self.store.world_height = value
+
+    @property
+    def rect(self):
+        return self.store.rects[self.index]
+
+    @rect.setter
+    def rect(self, value):
+        self.store.rects[self.index] = value
+
+    @property
+    def y_velocity(self):
+        return self.store.y_velocity[self.index]
+
+    @y_velocity.setter
+    def y_velocity(self, value):
+        self.store.y_velocity[self.index] = value
+
+    @property
+    def on_ground(self):
+        return bool(self.store.on_ground[self.index])
+
+    @on_ground.setter
+    def on_ground(self, value):
+        self.store.on_ground[self.index] = value
+
+    @property
+    def is_dead(self):
+        return bool(self.store.is_dead[self.index])
+
+    @is_dead.setter
+    def is_dead(self, value):
+        self.store.is_dead[self.index] = value
 
     def update_sprite(self):
-        sprite_key = f"{self.direction}{'R' if self.moving else 'P'}"
+        sprite_key_index = DIRECTION_INDEX[self.direction] * 2 + self.moving
         
-        new_image = self.sprites.get(sprite_key, 
-                                     self.sprites.get(f"{self.direction}P", 
-                                                      self.sprites.get("DownP", 
-                                                                       pygame.Surface([self.rect.width, self.rect.height], pygame.SRCALPHA))))
-
-        old_center_x = self.rect.centerx
-        old_bottom = self.rect.bottom
+        # Fall back to the standing frame of the direction, then to DownP, then keep the current image
+        sprites = self.sprites
+        new_image = sprites.get(SPRITE_KEYS[sprite_key_index])
+        if new_image is None:
+            new_image = sprites.get(SPRITE_KEYS[sprite_key_index & ~1])
+            if new_image is None:
+                new_image = sprites.get("DownP", self.image)
+        self.store.sprite_key[self.index] = sprite_key_index
+
+        # Resize the rect in place around its bottom centre
+        rect = self.rect
+        old_center_x = rect.centerx
+        old_bottom = rect.bottom
         self.image = new_image
-        self.rect = self.image.get_rect(centerx=old_center_x, bottom=old_bottom)
+        rect.size = new_image.get_size()
+        rect.centerx = old_center_x
+        rect.bottom = old_bottom
+        self.store.sync_position(self.index)
 
-    def move(self, keys, left_key, right_key, jump_key, platforms):
+    def move(self, keys, left_key, right_key, jump_key, platforms, bodies=()):
+        """One physics step. `bodies` are other characters that block this one like platforms do."""
         dx = 0
         self.moving = False 
 
@@ -258,15 +842,27 @@ class Character(pygame.sprite.Sprite):
             self.moving = False 
 
         self.y_velocity += GRAVITY
-        if self.y_velocity > 10: 
-            self.y_velocity = 10
+        if self.y_velocity > MAX_FALL_SPEED: 
+            self.y_velocity = MAX_FALL_SPEED
 
         self.rect.x += dx
-        self.handle_horizontal_collisions(platforms)
-
-        self.rect.y += self.y_velocity
+        self.store.x_velocity[self.index] = dx
+        self.handle_horizontal_collisions(platforms, bodies)
+
+        # rect.y follows the sub-pixel position; a rect moved from outside since the last step wins
+        store, index = self.store, self.index
+        sub_y = store.sub_y[index]
+        if sub_y >> SUBPIXEL_BITS != self.rect.y:
+            sub_y = (self.rect.y << SUBPIXEL_BITS) | (sub_y & SUBPIXEL_MASK)
+        sub_y += self.y_velocity
+        self.rect.y = sub_y >> SUBPIXEL_BITS
         self.on_ground = False 
-        self.handle_vertical_collisions(platforms)
+        self.handle_vertical_collisions(platforms, bodies)
+        if self.rect.y != sub_y >> SUBPIXEL_BITS:
+            # Pushed out of a solid: flush against its edge to the sub-pixel, so a character standing
+            # on a platform touches it again on every step and stays on the ground
+            sub_y = ((self.rect.y + 1) << SUBPIXEL_BITS) - 1 if self.on_ground else self.rect.y << SUBPIXEL_BITS
+        store.sub_y[index] = sub_y
 
         # Keep player within world bounds
         if self.rect.left < 0:
@@ -282,52 +878,197 @@ class Character(pygame.sprite.Sprite):
 
         self.update_sprite()
 
-    def handle_horizontal_collisions(self, platforms):
-        collided_platforms = pygame.sprite.spritecollide(self, platforms, False)
-        for platform in collided_platforms:
-            if self.rect.colliderect(platform.rect): 
-                if self.rect.x < platform.rect.x: 
-                    self.rect.right = platform.rect.left
-                elif self.rect.x > platform.rect.x: 
-                    self.rect.left = platform.rect.right
-
-    def handle_vertical_collisions(self, platforms):
-        collided_platforms = pygame.sprite.spritecollide(self, platforms, False)
-        for platform in collided_platforms:
-            if self.rect.colliderect(platform.rect): 
-                if self.y_velocity > 0: 
-                    self.rect.bottom = platform.rect.top
-                    self.y_velocity = 0
-                    self.on_ground = True
-                elif self.y_velocity < 0: 
-                    self.rect.top = platform.rect.bottom
-                    self.y_velocity = 0 
+    def handle_horizontal_collisions(self, platforms, bodies=()):
+        for solids in (platforms, bodies):
+            for platform in solids:
+                if self.rect.colliderect(platform.rect): 
+                    if self.rect.x < platform.rect.x: 
+                        self.rect.right = platform.rect.left
+                    elif self.rect.x > platform.rect.x: 
+                        self.rect.left = platform.rect.right
+
+    def handle_vertical_collisions(self, platforms, bodies=()):
+        for solids in (platforms, bodies):
+            for platform in solids:
+                if self.rect.colliderect(platform.rect): 
+                    if self.y_velocity > 0: 
+                        self.rect.bottom = platform.rect.top
+                        self.y_velocity = 0
+                        self.on_ground = True
+                    elif self.y_velocity < 0: 
+                        self.rect.top = platform.rect.bottom
+                        self.y_velocity = 0 
         
         if self.y_velocity == 0 and not self.on_ground: 
-            self.y_velocity = 1 
+            self.y_velocity = SUBPIXELS 
 
     def handle_hazards(self, static_hazards, moving_hazards): 
         for hazard in static_hazards:
-            if self.rect.colliderect(hazard.rect):
-                if self.rect.bottom >= hazard.rect.top + 5 and self.rect.top < hazard.rect.bottom: 
-                    return True 
+            if self.rect.colliderect(hazard.rect) and self.touches(hazard.rect):
+                return True 
         
         for m_hazard in moving_hazards: 
-            if self.rect.colliderect(m_hazard.rect):
+            if self.rect.colliderect(m_hazard.rect) and self.touches(m_hazard.rect):
                 return True 
         return False
 
-    def reset_position(self):
-        self.rect.topleft = self.start_pos
-        self.y_velocity = 0
-        self.on_ground = False
-        self.is_dead = False 
+    def touches(self, rect):
+        """Pixel test of the visible part of the sprite against a solid rect, after a rect hit."""
+        return get_sprite_mask(self.image).overlap(get_filled_mask(rect.width, rect.height),
+                                                   (rect.x - self.rect.x, rect.y - self.rect.y)) is not None
+
+    def get_state(self):
+        """(x, sub_y, y_velocity, on_ground, is_dead, sprite_key), all integers; sub_y and y_velocity in sub-pixels."""
+        return (self.rect.x, self.store.sub_y[self.index], self.y_velocity, self.on_ground, self.is_dead, self.store.sprite_key[self.index])
+
+    def set_state(self, state):
+        x, sub_y, y_velocity, on_ground, is_dead, sprite_key_index = state
+        sprite_key = SPRITE_KEYS[sprite_key_index]
+        self.direction = sprite_key[:-1]
+        self.moving = sprite_key.endswith("R")
+        sprites = self.sprites
+        self.image = sprites.get(sprite_key, sprites.get(f"{self.direction}P", sprites.get("DownP", self.image)))
+        self.rect = self.image.get_rect(topleft=(x, sub_y >> SUBPIXEL_BITS))
+        self.y_velocity = y_velocity
+        self.on_ground = on_ground
+        self.is_dead = is_dead
+        self.store.sprite_key[self.index] = sprite_key_index
+        self.store.sub_y[self.index] = sub_y
+        self.store.sync_position(self.index)
 
+    def reset_position(self):
+        start_x, start_y = self.start_pos
+        self.set_state((start_x, start_y << SUBPIXEL_BITS, 0, False, False, SPRITE_KEY_INDEX["DownP"]))
+
+
+class SweepAndPrune:
+    """Broadphase for character-to-character collisions.
+
+    Once per frame, before anyone moves, the living characters are sorted by the left edge of their
+    rect and swept along x. Every pair whose x intervals (and y intervals) come within the distance
+    both can move this frame becomes a candidate, so bodies_of() holds everyone a character can bump
+    into during its move. The order is kept between frames and is nearly sorted already, which the
+    sort takes advantage of, so a frame costs O(n log n) at worst plus the candidate pairs.
+    Pairs that already overlap at the start of the frame (e.g. players on the same spawn point) are
+    left out, so they can walk apart instead of being pushed around.
+    """
+    def __init__(self, margin_x=10, margin_y=2 * -JUMP_STRENGTH // SUBPIXELS):
+        self.margin_x = margin_x # Twice the walking speed: both characters of a pair may move
+        self.margin_y = margin_y # Twice the fastest vertical speed (a jump)
+        self.characters = None   # The list order was taken from
+        self.order = []          # Living characters by rect.left
+        self.bodies = []         # Entity store index -> candidate characters
+        self.pair_count = 0
+
+    def update(self, characters):
+        order = self.order
+        bodies = self.bodies
+        if characters is not self.characters or len(order) != len(characters) or any(character.is_dead for character in order):
+            self.characters = characters
+            order[:] = [character for character in characters if not character.is_dead]
+            for character in order:
+                while character.index >= len(bodies):
+                    bodies.append([])
+        order.sort(key=_rect_left)
+
+        for candidates in bodies:
+            candidates.clear()
+        margin_x, margin_y = self.margin_x, self.margin_y
+        active = [] # (right, top, bottom, character) of the characters whose x interval may reach further right
+        pair_count = 0
+        for character in order:
+            rect = character.rect
+            left = rect.left - margin_x
+            top = rect.top - margin_y
+            bottom = rect.bottom + margin_y
+            if active and active[0][0] <= left:
+                active = [entry for entry in active if entry[0] > left]
+            candidates = bodies[character.index]
+            for other_right, other_top, other_bottom, other in active:
+                if other_right > left and other_bottom > top and other_top < bottom and not other.rect.colliderect(rect):
+                    candidates.append(other)
+                    bodies[other.index].append(character)
+                    pair_count += 1
+            active.append((rect.right, rect.top, rect.bottom, character))
+        self.pair_count = pair_count
+
+    def bodies_of(self, character):
+        if character.index < len(self.bodies):
+            return self.bodies[character.index]
+        return ()
+
+
+def _rect_left(character):
+    return character.rect.left
+
+
+
+# Parallax Background
+# Layers are drawn behind the level and scroll horizontally at a fraction of the camera's speed.
+# name -> (scroll factor, colour, shape)
+BACKGROUND_LAYERS = {
+    "clouds": (0.1, (245, 248, 255), "clouds"),
+    "mountains": (0.25, (150, 170, 200), "mountains"),
+    "hills": (0.5, (105, 165, 110), "hills"),
+    "far_hills": (0.35, (140, 190, 140), "hills"),
+}
+
+_background_strips = {}
+
+BACKGROUND_COLORKEY = (255, 0, 255)
+
+def get_background_strip(name, width, height):
+    """Pre-renders a layer once per size into a strip that tiles horizontally.
+
+    Returns (strip, top): the strip is cropped to the rows the layer covers and starts `top` pixels
+    down the screen. Strips use an RLE colour key instead of per-pixel alpha, which blits much faster.
+    """
+    key = (name, width, height)
+    strip = _background_strips.get(key)
+    if strip is None:
+        _, color, shape = BACKGROUND_LAYERS[name]
+        strip = pygame.Surface((width, height))
+        strip.fill(BACKGROUND_COLORKEY)
+        rng = random.Random(name)
+        if shape == "clouds":
+            for _ in range(max(1, width // 250)):
+                cloud_x = rng.randrange(width)
+                cloud_y = rng.randrange(height // 3)
+                for _ in range(4):
+                    radius = rng.randint(height // 30, height // 15)
+                    center_x = cloud_x + rng.randint(-2 * radius, 2 * radius)
+                    center_y = cloud_y + rng.randint(-radius // 2, radius // 2)
+                    # Drawn twice, so a cloud crossing the right edge continues at the left edge
+                    for wrap_x in (center_x, center_x - width):
+                        pygame.draw.circle(strip, color, (wrap_x, center_y), radius)
+        else:
+            # Sums of sine waves with a whole number of periods across the strip tile seamlessly
+            base = height * (0.55 if shape == "mountains" else 0.7)
+            amplitude = height * (0.2 if shape == "mountains" else 0.08)
+            waves = [(rng.randint(1, 3), rng.uniform(0, 6.28), 1.0), (rng.randint(4, 9), rng.uniform(0, 6.28), 0.35)]
+            if shape == "mountains":
+                waves.append((rng.randint(12, 20), rng.uniform(0, 6.28), 0.15))
+            points = [(0, height)]
+            for x in range(0, width + 1, 4):
+                y = base - amplitude * sum(weight * math.sin(periods * 6.2832 * x / width + phase) for periods, phase, weight in waves)
+                points.append((x, int(y)))
+            points.append((width, height))
+            pygame.draw.polygon(strip, color, points)
+        strip.set_colorkey(BACKGROUND_COLORKEY, pygame.RLEACCEL)
+        covered = strip.get_bounding_rect()
+        strip = _background_strips[key] = (strip.subsurface(0, covered.top, width, covered.height).copy(), covered.top)
+        strip[0].set_colorkey(BACKGROUND_COLORKEY, pygame.RLEACCEL)
+    return strip
+
+
+DOOR_PERIOD = 120 # Ticks a timed door ('D') stays closed, then open, and so on
 
 
 class Level:
-    def __init__(self, level_map_data, BASE_TILE_SIZE=50, WORLD_SCALE_FACTOR=1.75):
+    def __init__(self, level_map_data, BASE_TILE_SIZE=50, WORLD_SCALE_FACTOR=1.75, background=()):
         self.level_map_data = level_map_data
+        self.background = background # Names of BACKGROUND_LAYERS, back to front
+        self.background_layers = len(background) # How many of them are drawn, the frontmost ones
         self.base_tile_size = BASE_TILE_SIZE
         self.world_scale_factor = WORLD_SCALE_FACTOR
 
@@ -340,70 +1081,259 @@ class Level:
         self.world_width_pixels = self.map_width_tiles * self.tile_size
         self.world_height_pixels = self.map_height_tiles * self.tile_size
 
-        self.platforms = pygame.sprite.Group() 
-        self.hazards = pygame.sprite.Group() 
-        self.moving_hazards = pygame.sprite.Group() 
+        self.platforms = [] 
+        self.hazards = [] 
+        self.moving_hazards = [] 
+        self.moving_hazard_store = EntityStore()
         self.finish_line = None
-        self.player1_start = None
-        self.player2_start = None
+        self.start_positions = [] # Spawn point per player number - 1
+        self.revision = 0 # Counts editor changes
 
         self._build_level()
 
     def _build_level(self):
-        self.platforms.empty()
-        self.hazards.empty()
-        self.moving_hazards.empty() 
+        self.platforms = []
+        self.hazards = []
+        self.moving_hazards = [] 
+        self.moving_hazard_store = EntityStore()
+        self.initial_hazard_state = (array("i"), array("i"))
+        self.timers = TimerWheel() # Ticks since the level was (re)started, drives the doors
+        self.doors = {} # (col, row) -> [door tile, its TimerEntry, open]
         self.finish_line = None
-        self.player1_start = None
-        self.player2_start = None
+        self.tile_grid = [row.ljust(self.map_width_tiles, '_') for row in self.level_map_data]
+        self.cells = {}        # (col, row) -> the tile or moving hazard built for that cell
+        self.marker_cells = {} # Spawn markers and 'F' -> (col, row) of that marker
+        self.static_blits = [] # [surface, screen rect] pairs of platforms and static hazards, in no particular order
+        self.static_blit_cells = [] # (col, row) of each pair in static_blits
+        self.cell_blit_index = {}   # (col, row) -> index in static_blits
+        self.moving_blits = []      # [surface, screen rect] per moving hazard, same order as moving_hazards
+        self.blit_offset_x = 0
+        self.blit_offset_y = 0
 
         for row_idx, row in enumerate(self.level_map_data):
             for col_idx, tile_char in enumerate(row):
-                x = col_idx * self.tile_size
-                y = row_idx * self.tile_size 
-
-                if tile_char == '#': 
-                    self.platforms.add(Tile(x, y, self.tile_size, GRAY, "platform"))
-                elif tile_char in ['L', 'W', 'S']: 
-                    
-                    self.hazards.add(HazardTile(x, y, self.tile_size, RED, "lethal_static_hazard")) 
-                elif tile_char == 'M': 
-                    self.moving_hazards.add(MovingHazardPlatform(x, y, self.tile_size, PURPLE, move_range_x=self.tile_size * 2, speed=2))
-                elif tile_char == '1': 
-                    self.player1_start = (x, y) 
-                elif tile_char == '2': 
-                    self.player2_start = (x, y)
-                elif tile_char == 'F': 
-                    self.finish_line = Tile(x, y, self.tile_size, YELLOW, "finish")
-
-        if not self.player1_start:
-            print("WARNING: Player 1 start point ('1') not found in level map! Defaulting to (0, 0).")
-            self.player1_start = (0, 0) 
-        if not self.player2_start:
-            print("WARNING: Player 2 start point ('2') not found in level map! Defaulting to near P1.")
-            self.player2_start = (self.player1_start[0] + self.tile_size, self.player1_start[1]) 
+                self._add_cell(col_idx, row_idx, tile_char)
+
+        self._apply_marker_defaults()
+        self.set_background_size(WIDTH, HEIGHT)
+
+    def _add_cell(self, col_idx, row_idx, tile_char):
+        x = col_idx * self.tile_size
+        y = row_idx * self.tile_size 
+
+        tile = None
+        if tile_char == '#': 
+            tile = Tile(x, y, self.tile_size, GRAY, "platform")
+            self.platforms.append(tile)
+        elif tile_char in ['L', 'W', 'S']: 
+            
+            tile = HazardTile(x, y, self.tile_size, RED, "lethal_static_hazard")
+            self.hazards.append(tile) 
+        elif tile_char == 'D':
+            tile = Tile(x, y, self.tile_size, BROWN, "door")
+            self.platforms.append(tile)
+        elif tile_char == 'M': 
+            moving_hazard = MovingHazardPlatform(x, y, self.tile_size, PURPLE, move_range_x=self.tile_size * 2, speed=2, store=self.moving_hazard_store)
+            self.moving_hazards.append(moving_hazard)
+            self.moving_blits.append([moving_hazard.image, moving_hazard.rect.copy()])
+            self.initial_hazard_state[0].append(moving_hazard.rect.x)
+            self.initial_hazard_state[1].append(self.moving_hazard_store.x_velocity[moving_hazard.index])
+            self.cells[(col_idx, row_idx)] = moving_hazard
+        elif tile_char in SPAWN_MARKERS: 
+            self.marker_cells[tile_char] = (col_idx, row_idx)
+        elif tile_char == 'F': 
+            self.finish_line = Tile(x, y, self.tile_size, YELLOW, "finish")
+            self.marker_cells['F'] = (col_idx, row_idx)
+
+        if tile is not None:
+            # Static tiles are only shifted when the camera moves, see draw()
+            entry = [tile.image, tile.rect.move(self.blit_offset_x, self.blit_offset_y)]
+            self.cells[(col_idx, row_idx)] = tile
+            self.cell_blit_index[(col_idx, row_idx)] = len(self.static_blits)
+            self.static_blits.append(entry)
+            self.static_blit_cells.append((col_idx, row_idx))
+            if tile_char == 'D':
+                self.doors[(col_idx, row_idx)] = [tile, None, False]
+                self._schedule_door(col_idx, row_idx)
+
+    def _remove_cell(self, col_idx, row_idx, tile_char):
+        """Undoes _add_cell. Lists whose order doesn't matter fill the gap with their last item."""
+        if tile_char in MARKERS:
+            if self.marker_cells.get(tile_char) == (col_idx, row_idx):
+                del self.marker_cells[tile_char]
+            return
+        tile = self.cells.pop((col_idx, row_idx), None)
+        if tile is None:
+            return
+        if tile_char == 'M':
+            i = tile.index
+            self.moving_hazard_store.remove(i)
+            for items in (self.moving_hazards, self.moving_blits, *self.initial_hazard_state):
+                items[i] = items[-1]
+                items.pop()
+            if i < len(self.moving_hazards):
+                self.moving_hazards[i].index = i
+            return
+
+        if tile_char == 'D':
+            _, entry, is_open = self.doors.pop((col_idx, row_idx))
+            entry.cancel()
+            if not is_open:
+                self.platforms.remove(tile)
+        else:
+            (self.platforms if tile_char == '#' else self.hazards).remove(tile)
+        i = self.cell_blit_index.pop((col_idx, row_idx))
+        last_entry = self.static_blits.pop()
+        last_cell = self.static_blit_cells.pop()
+        if i < len(self.static_blits):
+            self.static_blits[i] = last_entry
+            self.static_blit_cells[i] = last_cell
+            self.cell_blit_index[last_cell] = i
+
+    def _schedule_door(self, col_idx, row_idx):
+        """Opens or closes a door for the current tick and schedules its toggles. All doors switch on the same ticks."""
+        tick = self.timers.tick
+        self._set_door_open(col_idx, row_idx, (tick // DOOR_PERIOD) % 2 == 1)
+        self.doors[(col_idx, row_idx)][1] = self.timers.schedule(DOOR_PERIOD - tick % DOOR_PERIOD, self._toggle_door,
+                                                                 col_idx, row_idx, interval=DOOR_PERIOD)
+
+    def _toggle_door(self, col_idx, row_idx):
+        self._set_door_open(col_idx, row_idx, not self.doors[(col_idx, row_idx)][2])
+
+    def _set_door_open(self, col_idx, row_idx, is_open):
+        door = self.doors[(col_idx, row_idx)]
+        tile = door[0]
+        if door[2] == is_open:
+            return
+        door[2] = is_open
+        if is_open:
+            self.platforms.remove(tile)
+        else:
+            self.platforms.append(tile)
+        self.static_blits[self.cell_blit_index[(col_idx, row_idx)]][0] = EMPTY_SURFACE if is_open else tile.image
+
+    def set_tick(self, tick):
+        """Puts the level's clock at `tick`, e.g. when a snapshot is restored. Doors only depend on the tick."""
+        if 0 <= tick - self.timers.tick <= DOOR_PERIOD:
+            while self.timers.tick < tick:
+                self.timers.advance()
+            return
+        self.timers = TimerWheel(tick)
+        for col_idx, row_idx in self.doors:
+            self._schedule_door(col_idx, row_idx)
+
+    def _apply_marker_defaults(self):
+        """Builds start_positions from the spawn markers. Players 1 and 2 always get one, the others only if marked."""
+        self.start_positions = []
+        for player_number, marker in enumerate(SPAWN_MARKERS, start=1):
+            if marker in self.marker_cells:
+                col, row = self.marker_cells[marker]
+                self.start_positions.append((col * self.tile_size, row * self.tile_size))
+            elif player_number == 1:
+                event_log.warning("level_start_missing", player=1)
+                self.start_positions.append((0, 0))
+            elif player_number == 2:
+                event_log.warning("level_start_missing", player=2)
+                self.start_positions.append((self.start_positions[0][0] + self.tile_size, self.start_positions[0][1]))
         if not self.finish_line:
-            print("WARNING: Finish point ('F') not found in level map! Defaulting to top-right.")
+            event_log.warning("level_finish_missing")
             self.finish_line = Tile(self.tile_size * (self.map_width_tiles - 1), 0, self.tile_size, YELLOW, "finish") 
+        self.finish_blit = [self.finish_line.image, self.finish_line.rect.move(self.blit_offset_x, self.blit_offset_y)]
+        self.dynamic_blits = self.moving_blits + [self.finish_blit] # Finish line on top
+
+    def set_tile(self, col_idx, row_idx, tile_char):
+        """Editor: changes one cell and updates only what depends on it. Returns False if nothing changed."""
+        if not (0 <= col_idx < self.map_width_tiles and 0 <= row_idx < self.map_height_tiles):
+            return False
+        old_char = self.tile_grid[row_idx][col_idx]
+        if old_char == tile_char:
+            return False
+        if self.level_map_data is not self.tile_grid:
+            self.level_map_data = self.tile_grid # Edited levels stop sharing the campaign's strings
+
+        cells = []
+        if tile_char in self.marker_cells:
+            # Start points and the finish are unique, the old one is cleared first
+            cells.append((*self.marker_cells[tile_char], '_'))
+        cells.append((col_idx, row_idx, tile_char))
+        for col, row, char in cells:
+            self._remove_cell(col, row, self.tile_grid[row][col])
+            self.tile_grid[row] = self.tile_grid[row][:col] + char + self.tile_grid[row][col + 1:]
+            self._add_cell(col, row, char)
+        self.revision += 1
+
+        if old_char in MARKERS or tile_char in MARKERS:
+            # Defaults depend on each other (player 2 defaults to next to player 1), so all markers are placed again
+            self.finish_line = None
+            if 'F' in self.marker_cells:
+                self._add_cell(*self.marker_cells['F'], 'F')
+            self._apply_marker_defaults()
+        elif 'M' in (old_char, tile_char):
+            self.dynamic_blits = self.moving_blits + [self.finish_blit]
+        return True
+
+    def set_background_size(self, width, height):
+        """Builds two [strip, rect] pairs per drawn background layer for a screen of the given size."""
+        layers = self.background[max(0, len(self.background) - self.background_layers):]
+        self.background_scroll_factors = [BACKGROUND_LAYERS[name][0] for name in layers]
+        self.background_blits = []
+        for name in layers:
+            strip, top = get_background_strip(name, width, height)
+            self.background_blits.append([strip, pygame.Rect(0, top, width, strip.get_height())])
+            self.background_blits.append([strip, pygame.Rect(width, top, width, strip.get_height())])
+        self.background_width = width
+
+    def reset(self):
+        """Puts the moving hazards back where they started and the clock back to 0."""
+        self.set_tick(0)
+        store = self.moving_hazard_store
+        initial_x, initial_x_velocity = self.initial_hazard_state
+        store.x_velocity[:] = initial_x_velocity
+        for rect, x in zip(store.rects, initial_x):
+            rect.x = x
 
 
     def draw(self, surface, camera):
         surface.fill(SKY_BLUE) 
 
-        for p in self.platforms:
-            p.draw(surface, camera)
-        for h in self.hazards:
-            h.draw(surface, camera)
-        for mh in self.moving_hazards: 
-            mh.draw(surface, camera)
-        if self.finish_line:
-            self.finish_line.draw(surface, camera)
+        offset_x = camera.camera.x
+        offset_y = camera.camera.y
+        if self.background_scroll_factors:
+            if surface.get_width() != self.background_width:
+                self.set_background_size(surface.get_width(), surface.get_height())
+            width = self.background_width
+            i = 0
+            for scroll_factor in self.background_scroll_factors:
+                x = -(int(-offset_x * scroll_factor) % width)
+                self.background_blits[i][1].x = x
+                self.background_blits[i + 1][1].x = x + width
+                i += 2
+        if offset_x != self.blit_offset_x or offset_y != self.blit_offset_y:
+            dx = offset_x - self.blit_offset_x
+            dy = offset_y - self.blit_offset_y
+            for _, rect in self.static_blits:
+                rect.move_ip(dx, dy)
+            self.finish_blit[1].move_ip(dx, dy)
+            self.blit_offset_x = offset_x
+            self.blit_offset_y = offset_y
+        world_rects = self.moving_hazard_store.rects
+        i = 0 # Counted by hand, zip() would allocate every frame
+        for _, rect in self.moving_blits:
+            rect.update(world_rects[i])
+            rect.move_ip(offset_x, offset_y)
+            i += 1
+        # Three lists so editing a static tile never has to rebuild one combined sequence
+        surface.blits(self.background_blits, doreturn=False)
+        surface.blits(self.static_blits, doreturn=False)
+        surface.blits(self.dynamic_blits, doreturn=False)
 
     def update(self):
-        self.moving_hazards.update() 
+        self.moving_hazard_store.update_patrols() 
+        self.timers.advance()
 
-    def get_start_positions(self):
-        return self.player1_start, self.player2_start
+    def get_start_positions(self, count=2):
+        """Spawn points for `count` players. Players without a marker of their own share the marked ones in turn."""
+        return [self.start_positions[i % len(self.start_positions)] for i in range(count)]
     
     def get_tile_size(self):
         return self.tile_size
@@ -425,7 +1355,7 @@ class Menu:
         screen.blit(text_solo, (WIDTH // 2 - text_solo.get_width() // 2, HEIGHT // 2 - 50))
         screen.blit(text_coop, (WIDTH // 2 - text_coop.get_width() // 2, HEIGHT // 2))
         
-        pygame.display.flip()
+        present()
 
     def select_mode(self):
         running = True
@@ -497,7 +1427,7 @@ class Menu:
                 number_text = menu_font.render(str(i+4), True, BLACK)
                 screen.blit(number_text, (slot_center_x - number_text.get_width() // 2, female_skins_start_y + 60))
 
-        pygame.display.flip()
+        present()
 
     def select_skin(self, character_skins_library, player_number):
         running = True
@@ -514,36 +1444,160 @@ class Menu:
                         if str(selected_index) in character_skins_library["Male"] and "DownP" in character_skins_library["Male"][str(selected_index)]:
                             return "Male", str(selected_index)
                         else:
-                            print(f"Skin Male {selected_index} not fully loaded or invalid key. Please check sprite files.")
+                            event_log.warning("skin_unavailable", skin=f"Male:{selected_index}")
                     elif pygame.K_5 <= event.key <= pygame.K_8:
                         selected_index = int(event.unicode)
                         female_skin_num = str(selected_index - 4) 
                         if female_skin_num in character_skins_library["Femal"] and "DownP" in character_skins_library["Femal"][female_skin_num]:
                             return "Femal", female_skin_num 
                         else:
-                            print(f"Skin Femal {female_skin_num} (selected as {selected_index}) not fully loaded or invalid key. Please check sprite files.")
+                            event_log.warning("skin_unavailable", skin=f"Femal:{female_skin_num}")
         return None, None 
 
 
 
+PARTICLE_POOL_SIZE = 1024    # Hard cap on live particles, bounds the update and draw cost per frame
+PARTICLE_SPAWN_BUDGET = 128  # New particles per frame, further emits are cut short
+PARTICLE_GRAVITY = 0.3
+PARTICLE_SIZE = 4
+
+
+class ParticleSystem:
+    """Fixed pool of particles in flat arrays: position, velocity, remaining lifetime and colour.
+
+    Slots of expired particles go back on a free list and are reused, so emitting never allocates.
+    With NumPy the whole pool is updated with array operations on views of the same buffers.
+    """
+    def __init__(self, capacity=PARTICLE_POOL_SIZE, spawn_budget=PARTICLE_SPAWN_BUDGET):
+        self.capacity = capacity
+        self.spawn_budget = spawn_budget
+        self.spawned_this_frame = 0
+        self.x = array("f", bytes(4 * capacity))
+        self.y = array("f", bytes(4 * capacity))
+        self.x_velocity = array("f", bytes(4 * capacity))
+        self.y_velocity = array("f", bytes(4 * capacity))
+        self.life = array("h", bytes(2 * capacity)) # Frames left, 0 is a free slot
+        self.color = array("H", bytes(2 * capacity)) # Index into self.palette
+        self.palette = []
+        self.palette_index = {} # Colour -> its index in self.palette
+        self.free_slots = list(range(capacity - 1, -1, -1))
+        self.draw_rect = pygame.Rect(0, 0, PARTICLE_SIZE, PARTICLE_SIZE) # Moved to each particle in turn
+        if np is not None:
+            self.x_view = np.frombuffer(self.x, dtype=np.float32)
+            self.y_view = np.frombuffer(self.y, dtype=np.float32)
+            self.x_velocity_view = np.frombuffer(self.x_velocity, dtype=np.float32)
+            self.y_velocity_view = np.frombuffer(self.y_velocity, dtype=np.float32)
+            self.life_view = np.frombuffer(self.life, dtype=np.int16)
+
+    def live_count(self):
+        return self.capacity - len(self.free_slots)
+
+    def emit(self, x, y, count, color, speed=4.0, lifetime=30, upward=0.0):
+        """Spawns up to `count` particles at (x, y) flying out in random directions."""
+        count = min(count, self.spawn_budget - self.spawned_this_frame, len(self.free_slots))
+        if count <= 0:
+            return
+        color_index = self.palette_index.get(color)
+        if color_index is None:
+            if len(self.palette) > 0xFFFF:
+                raise ValueError(f"particle palette is full ({len(self.palette)} colours)")
+            color_index = self.palette_index[color] = len(self.palette)
+            self.palette.append(color)
+        self.spawned_this_frame += count
+        for _ in range(count):
+            i = self.free_slots.pop()
+            self.x[i] = x
+            self.y[i] = y
+            self.x_velocity[i] = random.uniform(-speed, speed)
+            self.y_velocity[i] = random.uniform(-speed, speed) - upward
+            self.life[i] = random.randint(lifetime // 2, lifetime)
+            self.color[i] = color_index
+
+    def update(self):
+        self.spawned_this_frame = 0
+        if self.live_count() == 0:
+            return
+        if np is not None:
+            alive = self.life_view > 0
+            np.add(self.x_view, self.x_velocity_view, out=self.x_view, where=alive)
+            np.add(self.y_view, self.y_velocity_view, out=self.y_view, where=alive)
+            np.add(self.y_velocity_view, PARTICLE_GRAVITY, out=self.y_velocity_view, where=alive)
+            np.subtract(self.life_view, 1, out=self.life_view, where=alive)
+            self.free_slots.extend(np.flatnonzero(alive & (self.life_view == 0)).tolist())
+        else:
+            for i in range(self.capacity):
+                if self.life[i] > 0:
+                    self.x[i] += self.x_velocity[i]
+                    self.y[i] += self.y_velocity[i]
+                    self.y_velocity[i] += PARTICLE_GRAVITY
+                    self.life[i] -= 1
+                    if self.life[i] == 0:
+                        self.free_slots.append(i)
+
+    def draw(self, surface, camera):
+        if self.live_count() == 0:
+            return
+        offset_x, offset_y = camera.camera.topleft
+        rect, palette, fill = self.draw_rect, self.palette, surface.fill
+        # Straight over the pool arrays, so drawing allocates no list of live slots
+        for x, y, life, color in zip(self.x, self.y, self.life, self.color):
+            if life:
+                rect.x = int(x) + offset_x
+                rect.y = int(y) + offset_y
+                fill(palette[color], rect)
+
+    def clear(self):
+        for i in range(self.capacity):
+            self.life[i] = 0
+        self.free_slots = list(range(self.capacity - 1, -1, -1))
+        self.spawned_this_frame = 0
+
+
 class Timer:
+    """Game clock on the monotonic perf_counter_ns, so system clock changes don't affect times."""
     def __init__(self):
-        self.start_time = None
-        self.elapsed_time = 0
+        self.start_ns = None
+        self.elapsed_ns = 0
+        self.splits = []
 
     def start(self):
-        self.start_time = time.time()
-        self.elapsed_time = 0
+        self.start_ns = time.perf_counter_ns()
+        self.elapsed_ns = 0
+        self.splits = []
 
     def stop(self):
-        if self.start_time is not None:
-            self.elapsed_time = time.time() - self.start_time
-            self.start_time = None
+        if self.start_ns is not None:
+            self.elapsed_ns += time.perf_counter_ns() - self.start_ns
+            self.start_ns = None
+
+    def pause(self):
+        self.stop()
+
+    def resume(self):
+        if self.start_ns is None:
+            self.start_ns = time.perf_counter_ns()
+
+    def is_running(self):
+        return self.start_ns is not None
+
+    def split(self):
+        """Records and returns the current elapsed time in seconds."""
+        elapsed = self.get_elapsed_time()
+        self.splits.append(elapsed)
+        return elapsed
+
+    def get_elapsed_ns(self):
+        if self.start_ns is not None:
+            return self.elapsed_ns + time.perf_counter_ns() - self.start_ns
+        return self.elapsed_ns
 
     def get_elapsed_time(self):
-        if self.start_time is not None:
-            return time.time() - self.start_time
-        return self.elapsed_time
+        return self.get_elapsed_ns() / 1_000_000_000
+
+    def set_elapsed_time(self, seconds):
+        self.elapsed_ns = int(seconds * 1_000_000_000)
+        if self.start_ns is not None:
+            self.start_ns = time.perf_counter_ns()
 
     def format_time(self):
         return self.format_time_from_seconds(self.get_elapsed_time())
@@ -556,15 +1610,1501 @@ class Timer:
         return f"{minutes:02}:{seconds:02}"
 
 
+# Timer Wheel
+# Timed events (doors, delayed respawns) are scheduled in game ticks on a hierarchical timer wheel
+# instead of being polled by every object each frame. Level 0 has one slot per tick for the next
+# 256 ticks, each further level one slot per 256 slots of the level below. An entry goes into the
+# level its distance fits, and moves down a level ("cascades") when the level below comes round to
+# its range, so a tick only touches the one slot that is due, plus a cascade every 256 ticks.
+TIMER_WHEEL_BITS = 8
+TIMER_WHEEL_LEVELS = 4 # Delays of up to 2**32 ticks
+TIMER_WHEEL_MASK = (1 << TIMER_WHEEL_BITS) - 1
+
+
+class TimerEntry:
+    __slots__ = ("deadline", "interval", "callback", "args", "active")
+
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline # Tick it runs on
+        self.interval = interval # Ticks between repeats, 0 runs once
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+    def cancel(self):
+        """Cancelled entries stay in their slot and are dropped when it comes due."""
+        self.active = False
+
+
+class TimerWheel:
+    """Runs callbacks a number of ticks from now. advance() is called once per game tick."""
+    def __init__(self, tick=0):
+        self.tick = tick
+        self.slots = [[[] for _ in range(1 << TIMER_WHEEL_BITS)] for _ in range(TIMER_WHEEL_LEVELS)]
+        self.scheduled = 0 # Entries in the slots, cancelled ones included
+
+    def schedule(self, delay, callback, *args, interval=0):
+        """Runs callback(*args) after `delay` ticks (at least 1), then every `interval` ticks if given."""
+        if delay >= 1 << (TIMER_WHEEL_BITS * TIMER_WHEEL_LEVELS):
+            raise ValueError(f"delay of {delay} ticks is beyond the timer wheel")
+        entry = TimerEntry(self.tick + max(1, delay), interval, callback, args)
+        self._insert(entry)
+        return entry
+
+    def ticks_left(self, entry):
+        return entry.deadline - self.tick
+
+    def _insert(self, entry):
+        distance = entry.deadline - self.tick
+        level = 0
+        while distance >> (TIMER_WHEEL_BITS * (level + 1)) and level < TIMER_WHEEL_LEVELS - 1:
+            level += 1
+        self.slots[level][(entry.deadline >> (TIMER_WHEEL_BITS * level)) & TIMER_WHEEL_MASK].append(entry)
+        self.scheduled += 1
+
+    def advance(self):
+        """Moves on one tick and runs the entries that are due. Returns how many ran."""
+        self.tick += 1
+        tick = self.tick
+        # Every 256 ticks the next slot of level 1 is spread over level 0, every 65536 ticks one of level 2, ...
+        level = 0
+        while level < TIMER_WHEEL_LEVELS - 1 and not (tick >> (TIMER_WHEEL_BITS * level)) & TIMER_WHEEL_MASK:
+            level += 1
+        for level in range(level, 0, -1):
+            slots = self.slots[level]
+            index = (tick >> (TIMER_WHEEL_BITS * level)) & TIMER_WHEEL_MASK
+            entries = slots[index]
+            if entries:
+                slots[index] = []
+                self.scheduled -= len(entries)
+                for entry in entries:
+                    if entry.active:
+                        self._insert(entry)
+
+        slots = self.slots[0]
+        entries = slots[tick & TIMER_WHEEL_MASK]
+        if not entries:
+            return 0
+        slots[tick & TIMER_WHEEL_MASK] = []
+        self.scheduled -= len(entries)
+        ran = 0
+        for entry in entries:
+            if not entry.active:
+                continue
+            if entry.interval:
+                entry.deadline += entry.interval
+                self._insert(entry)
+            else:
+                entry.active = False
+            entry.callback(*entry.args)
+            ran += 1
+        return ran
+
+
+
+FRAME_RATE = int(os.environ.get("MAZEQUEST_FPS", "60"))
+FRAME_SPIN_NS = 2_000_000 # the last 2 ms of each frame are busy-waited instead of slept
+
+
+class FramePacer:
+    """Replacement for pygame.time.Clock: sleeps for most of the frame and spin-waits the rest."""
+    def __init__(self, target_fps=FRAME_RATE, spin_ns=FRAME_SPIN_NS):
+        self.target_fps = target_fps
+        self.spin_ns = spin_ns
+        self.deadline_ns = None
+        self.last_tick_ns = None
+        self.last_wait_ms = 0.0 # Time the last tick spent waiting
+        self.frame_intervals = deque(maxlen=600) # ms between ticks
+
+    def tick(self, target_fps=None):
+        """Waits until the next frame is due and returns the ms since the previous tick."""
+        frame_ns = 1_000_000_000 // (target_fps or self.target_fps)
+        now = wait_start_ns = time.perf_counter_ns()
+        if self.deadline_ns is None or now >= self.deadline_ns + frame_ns:
+            # First frame, or this frame ran over its budget: start a new schedule instead of
+            # shortening the next frames to catch up, which would show as stutter
+            self.deadline_ns = now
+        else:
+            self.deadline_ns += frame_ns
+            remaining = self.deadline_ns - now
+            if remaining > self.spin_ns:
+                time.sleep((remaining - self.spin_ns) / 1_000_000_000)
+            while time.perf_counter_ns() < self.deadline_ns:
+                time.sleep(0) # yield, so the loader and leaderboard threads can still run
+            now = time.perf_counter_ns()
+            if now - self.deadline_ns > self.spin_ns:
+                # Overslept (the OS scheduled us late), continue the schedule from here
+                self.deadline_ns = now
+
+        self.last_wait_ms = (now - wait_start_ns) / 1_000_000
+        interval_ms = 0
+        if self.last_tick_ns is not None:
+            interval_ms = (now - self.last_tick_ns) / 1_000_000
+            self.frame_intervals.append(interval_ms)
+        self.last_tick_ns = now
+        return interval_ms
+
+    def stats(self):
+        """Returns (mean, standard deviation, worst) of the recent frame intervals in ms."""
+        if not self.frame_intervals:
+            return 0.0, 0.0, 0.0
+        mean = sum(self.frame_intervals) / len(self.frame_intervals)
+        variance = sum((interval - mean) ** 2 for interval in self.frame_intervals) / len(self.frame_intervals)
+        return mean, variance ** 0.5, max(self.frame_intervals)
+
+    def report(self):
+        mean, stddev, worst = self.stats()
+        print(f"Frame pacing: {len(self.frame_intervals)} frames at {self.target_fps} fps target, "
+              f"mean {mean:.3f} ms, stddev {stddev:.3f} ms, worst {worst:.3f} ms")
+
+
+# Quality Governor
+# Steps the rendering quality down when the playing loop keeps overrunning its frame budget, and
+# back up when there is headroom again. It watches the work time of each frame (without the time
+# FramePacer sleeps), so headroom is visible too. Stepping up needs a lower load held for longer
+# than stepping down, and the wait doubles every time an upgrade has to be taken back, so the
+# level settles instead of flipping between two neighbours.
+# Each level: (particle spawn budget, parallax layers), best first. The render scale is not one of the
+# knobs: the upscale back to the window costs about as much as the smaller frame saves, and a lot
+# more with smoothscale.
+QUALITY_LEVELS = (
+    (PARTICLE_SPAWN_BUDGET, 3),
+    (PARTICLE_SPAWN_BUDGET // 2, 2),
+    (PARTICLE_SPAWN_BUDGET // 4, 1),
+    (0, 0),
+)
+QUALITY_SETTING = os.environ.get("MAZEQUEST_QUALITY", "auto") # "auto" or a fixed level
+QUALITY_WINDOW = 60        # Frames averaged before a decision
+QUALITY_DOWN_LOAD = 0.9    # Step down when the average work time is above this share of the budget
+QUALITY_UP_LOAD = 0.6      # Step up when it stays below this share...
+QUALITY_UP_FRAMES = 180    # ...for this many frames
+QUALITY_UP_FRAMES_MAX = 3600
+
+
+class QualityGovernor:
+    """Decides the quality level from frame work times. Knows nothing of pygame, so it can be fed made-up timings."""
+    def __init__(self, budget_ms=1000 / FRAME_RATE, level=0, levels=len(QUALITY_LEVELS), window=QUALITY_WINDOW,
+                 down_load=QUALITY_DOWN_LOAD, up_load=QUALITY_UP_LOAD, up_frames=QUALITY_UP_FRAMES):
+        self.budget_ms = budget_ms
+        self.level = level
+        self.levels = levels
+        self.window = window
+        self.down_load = down_load
+        self.up_load = up_load
+        self.base_up_frames = up_frames
+        self.up_frames = up_frames
+        self.frame_times = deque(maxlen=window)
+        self.total_ms = 0.0
+        self.headroom_frames = 0 # Frames in a row with the average below up_load
+        self.change_load = 0.0   # Load that caused the last change
+        self.upgraded = False    # The last change was a step up that hasn't held a full window yet
+
+    def observe(self, frame_ms):
+        """Takes the work time of one frame. Returns the new level when it changes, otherwise None."""
+        if len(self.frame_times) == self.window:
+            self.total_ms -= self.frame_times[0]
+        self.frame_times.append(frame_ms)
+        self.total_ms += frame_ms
+        if len(self.frame_times) < self.window:
+            return None
+        load = self.total_ms / self.window / self.budget_ms
+
+        if load > self.down_load:
+            self.headroom_frames = 0
+            if self.level == self.levels - 1:
+                return None
+            if self.upgraded:
+                # That level was too much after all, wait longer before trying it again
+                self.up_frames = min(2 * self.up_frames, QUALITY_UP_FRAMES_MAX)
+            return self._change(self.level + 1, upgraded=False)
+
+        if self.upgraded:
+            # The upgrade held a full window
+            self.upgraded = False
+            self.up_frames = self.base_up_frames
+        if load < self.up_load and self.level > 0:
+            self.headroom_frames += 1
+            if self.headroom_frames >= self.up_frames:
+                return self._change(self.level - 1, upgraded=True)
+        else:
+            self.headroom_frames = 0
+        return None
+
+    def load(self):
+        """Average work time of the current window as a share of the budget."""
+        return self.total_ms / len(self.frame_times) / self.budget_ms if self.frame_times else 0.0
+
+    def _change(self, level, upgraded):
+        self.change_load = self.load()
+        self.level = level
+        self.upgraded = upgraded
+        # Frames from before the change say nothing about the new level
+        self.frame_times.clear()
+        self.total_ms = 0.0
+        self.headroom_frames = 0
+        return level
+
+
+# Frame Profiler
+# F10 (or --profile N / MAZEQUEST_PROFILE=N from the start) profiles the next frames of Game.run with
+# cProfile and, beside it, a thread sampling the game thread's stack. Nothing is hooked in while no
+# session runs, the game loop only checks Game.profiler once per frame.
+PROFILE_KEY = pygame.K_F10
+PROFILE_FRAMES = 300
+PROFILE_DIR = os.environ.get("MAZEQUEST_PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+PROFILE_SAMPLE_INTERVAL = 0.001 # Seconds between stack samples
+
+
+class FrameProfiler:
+    """One profiling session over a fixed number of frames.
+
+    Writes <name>.prof (pstats, for snakeviz or python -m pstats), <name>.folded (collapsed stacks,
+    one "outer;inner count" line each, for flamegraph.pl or speedscope) and <name>.json with the
+    frame times of the session and what describe() returns (e.g. the level and the player count)
+    at its start and at its end.
+    """
+    def __init__(self, frames=PROFILE_FRAMES, directory=PROFILE_DIR, describe=dict):
+        self.frames = frames
+        self.directory = directory
+        self.describe = describe
+        self.start_info = describe()
+        self.frame_times = []
+        self.stacks = {} # Collapsed stack -> samples
+        self.started = time.strftime("%Y%m%d-%H%M%S")
+        self.target_thread_id = threading.get_ident()
+        self.stop_sampling = threading.Event()
+        self.sampler = threading.Thread(target=self._sample_loop, name="frame-profiler", daemon=True)
+        self.profile = cProfile.Profile()
+        self.sampler.start()
+        self.profile.enable()
+
+    def _sample_loop(self):
+        stacks = self.stacks
+        while not self.stop_sampling.wait(PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.target_thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack = ";".join(reversed(names))
+            stacks[stack] = stacks.get(stack, 0) + 1
+
+    def end_frame(self, frame_ms):
+        """Counts a finished frame. Returns True once the session is over and its files are written."""
+        self.frame_times.append(frame_ms)
+        if len(self.frame_times) < self.frames:
+            return False
+        self.stop()
+        return True
+
+    def stop(self):
+        """Ends the session and writes its files. Returns their path without the extension."""
+        self.profile.disable()
+        self.stop_sampling.set()
+        self.sampler.join()
+        os.makedirs(self.directory, exist_ok=True)
+        base_path = os.path.join(self.directory, f"profile-{self.started}-f{self.start_info.get('frame', 0)}")
+        pstats.Stats(self.profile).dump_stats(base_path + ".prof")
+        with open(base_path + ".folded", "w", encoding="utf-8") as folded_file:
+            for stack, samples in sorted(self.stacks.items()):
+                folded_file.write(f"{stack} {samples}\n")
+        frame_times = self.frame_times or [0.0]
+        with open(base_path + ".json", "w", encoding="utf-8") as info_file:
+            json.dump(dict(start=self.start_info, end=self.describe(), frames=len(self.frame_times), samples=sum(self.stacks.values()),
+                           mean_frame_ms=round(sum(frame_times) / len(frame_times), 3), worst_frame_ms=round(max(frame_times), 3),
+                           frame_times_ms=[round(frame_ms, 3) for frame_ms in self.frame_times]), info_file)
+        event_log.info("profile_saved", path=base_path, frames=len(self.frame_times), worst_ms=round(max(frame_times), 2))
+        return base_path
+
+
+LEADERBOARD_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "leaderboard.db")
+LEADERBOARD_BATCH_SIZE = 64
+
+
+class Leaderboard:
+    """Finish times in a local SQLite database.
+
+    record() only queues the result, a background thread writes queued results in batches and
+    then works out their rank, so finishing a level never waits on the disk.
+    """
+    def __init__(self, path=LEADERBOARD_PATH):
+        self.path = path
+        self.write_queue = queue.Queue()
+        self.ranks = {} # Entry id -> rank within its level and mode, filled in by the writer thread
+        self.failed_entries = set() # Entry ids the writer thread could not store
+        self.next_entry_id = 0
+        self.writer = threading.Thread(target=self._write_loop, name="leaderboard-writer", daemon=True)
+        self.writer.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("""CREATE TABLE IF NOT EXISTS results (
+                                  id INTEGER PRIMARY KEY,
+                                  level INTEGER NOT NULL,
+                                  mode TEXT NOT NULL,
+                                  skin TEXT NOT NULL,
+                                  time REAL NOT NULL,
+                                  retries_used INTEGER NOT NULL,
+                                  timestamp REAL NOT NULL)""")
+        connection.execute("CREATE INDEX IF NOT EXISTS results_by_level_mode_time ON results (level, mode, time)")
+        return connection
+
+    def record(self, level, mode, skin, time_seconds, retries_used):
+        """Queues a finish time. Returns an id for get_rank()."""
+        entry_id = self.next_entry_id
+        self.next_entry_id += 1
+        self.write_queue.put((entry_id, level, mode, skin, time_seconds, retries_used, time.time()))
+        return entry_id
+
+    def get_rank(self, entry_id):
+        """Rank of a recorded time, or None while it hasn't been written yet or couldn't be."""
+        return self.ranks.get(entry_id)
+
+    def has_failed(self, entry_id):
+        """Whether a recorded time was lost because the database couldn't be written."""
+        return entry_id in self.failed_entries
+
+    def top_times(self, level, mode, limit=10):
+        connection = self._connect()
+        try:
+            return connection.execute("SELECT skin, time, retries_used, timestamp FROM results "
+                                      "WHERE level = ? AND mode = ? ORDER BY time LIMIT ?", (level, mode, limit)).fetchall()
+        finally:
+            connection.close()
+
+    def _write_loop(self):
+        connection = None
+        running = True
+        while running:
+            batch = [self.write_queue.get()]
+            while len(batch) < LEADERBOARD_BATCH_SIZE:
+                try:
+                    batch.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+            if not batch:
+                continue
+
+            try:
+                if connection is None:
+                    connection = self._connect()
+                with connection:
+                    connection.executemany("INSERT INTO results (level, mode, skin, time, retries_used, timestamp) "
+                                           "VALUES (?, ?, ?, ?, ?, ?)", [entry[1:] for entry in batch])
+                for entry_id, level, mode, _, time_seconds, _, _ in batch:
+                    faster = connection.execute("SELECT COUNT(*) FROM results WHERE level = ? AND mode = ? AND time < ?",
+                                                (level, mode, time_seconds)).fetchone()[0]
+                    self.ranks[entry_id] = faster + 1
+            except sqlite3.Error as error:
+                # A read-only directory or a database locked by another game costs this batch, not the writer
+                self.failed_entries.update(entry[0] for entry in batch if entry[0] not in self.ranks)
+                event_log.error("leaderboard_write_failed", path=self.path, results=len(batch), error=repr(error))
+                if connection is not None:
+                    connection.close()
+                    connection = None # The next batch reconnects
+
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        """Writes whatever is still queued and stops the writer thread."""
+        self.write_queue.put(None)
+        self.writer.join(timeout=5)
+
+
+
+# Network Co-op
+# One host runs the authoritative Game, one client joins over UDP and controls player 2.
+NET_PORT = 47800
+NET_HELLO = 1
+NET_WELCOME = 2
+NET_INPUT = 3
+NET_SNAPSHOT = 4
+NET_INPUT_REDUNDANCY = 4   # Every input packet repeats the last few inputs, so a lost packet costs nothing
+NET_MAX_QUEUED_INPUTS = 8
+NET_HISTORY = 64           # Sent snapshots kept as possible delta bases
+NET_MAX_UNACKED_INPUTS = 256 # Client inputs remembered until a snapshot covers them, older ones are forgotten
+NET_LATENCY_SAMPLES = 10000  # Input latencies kept for the client's report
+
+INPUT_HEADER = struct.Struct("!BIIB")       # type, acked snapshot tick, newest input seq, input count
+SNAPSHOT_HEADER = struct.Struct("!BIIIH")   # type, tick, base tick, last processed input seq, state length
+SNAPSHOT_FIELD = struct.Struct("!Hi")       # index, value of one changed state field
+
+
+
+INPUT_QUEUE_SIZE = 256 # Timestamped key transitions kept for latency measurements
+JUMP_BUFFER_FRAMES = int(os.environ.get("MAZEQUEST_JUMP_BUFFER", "6")) # A jump pressed this many frames before landing still counts
+
+
+class InputQueue:
+    """Keyboard state built from the event queue instead of pygame.key.get_pressed().
+
+    get_pressed() only shows what is held when it is called, so a press released before the next
+    poll is never seen. Here every KEYDOWN counts for the next physics step even if the key was
+    already released, and jump presses stay buffered for a few frames so they can land early.
+    Indexing with a key gives the sampled state, so the queue is passed to Character.move() as `keys`.
+    """
+    def __init__(self, buffered_keys=(), buffer_frames=JUMP_BUFFER_FRAMES):
+        self.transitions = deque(maxlen=INPUT_QUEUE_SIZE) # (perf_counter_ns, key, pressed)
+        self.held = set()
+        self.pressed = set() # Pressed since the last sample
+        self.tapped = set()  # Pressed between the previous sample and the current one
+        self.buffer_frames = buffer_frames
+        self.buffer_left = dict.fromkeys(buffered_keys, 0) # Buffered key -> samples its last press still counts for
+        self.polled_events = [] # Key events taken off the queue by poll(), handed out by the next drain()
+
+    def record(self, event):
+        if event.type == pygame.KEYDOWN:
+            self.transitions.append((time.perf_counter_ns(), event.key, True))
+            self.held.add(event.key)
+            self.pressed.add(event.key)
+        elif event.type == pygame.KEYUP:
+            self.transitions.append((time.perf_counter_ns(), event.key, False))
+            self.held.discard(event.key)
+        elif event.type == pygame.WINDOWFOCUSLOST:
+            self.held.clear()
+
+    def drain(self):
+        """All pending events, for the top of the frame. Replaces pygame.event.get()."""
+        events = self.polled_events
+        self.polled_events = []
+        for event in pygame.event.get():
+            self.record(event)
+            events.append(event)
+        return events
+
+    def poll(self):
+        """Takes the key events that arrived since the last drain() or poll() off the queue."""
+        for event in pygame.event.get((pygame.KEYDOWN, pygame.KEYUP)):
+            self.record(event)
+            self.polled_events.append(event)
+
+    def sample(self):
+        """Polls once more and fixes the key state for this frame's physics step. Returns self."""
+        self.poll()
+        self.tapped, self.pressed = self.pressed, self.tapped
+        self.pressed.clear()
+        for key, frames_left in self.buffer_left.items():
+            if key in self.tapped:
+                self.buffer_left[key] = self.buffer_frames
+            elif frames_left:
+                self.buffer_left[key] = frames_left - 1
+        return self
+
+    def consume(self, key):
+        """Ends the buffering of a press once it had its effect, so one press can't jump twice."""
+        if key in self.buffer_left:
+            self.buffer_left[key] = 0
+
+    def reset(self):
+        """Forgets presses that weren't used, e.g. keys typed in the editor or while paused."""
+        self.pressed.clear()
+        self.tapped.clear()
+        for key in self.buffer_left:
+            self.buffer_left[key] = 0
+
+    def __getitem__(self, key):
+        return key in self.held or key in self.tapped or self.buffer_left.get(key, 0) > 0
+
+
+def buttons_from_keys(keys, left_key, right_key, jump_key):
+    return int(keys[left_key]) | (int(keys[right_key]) << 1) | (int(keys[jump_key]) << 2)
+
+
+BUTTON_KEYS = tuple((bool(buttons & 1), bool(buttons & 2), bool(buttons & 4)) for buttons in range(8))
+
+
+def buttons_to_keys(buttons):
+    """Turns a button bitmask into a keys sequence for Character.move(keys, 0, 1, 2, ...)."""
+    return BUTTON_KEYS[buttons]
+
+
+def encode_state_delta(state, base):
+    """Packs the fields of `state` that differ from `base`. Fields missing from base count as 0."""
+    changes = []
+    for i, value in enumerate(state):
+        if value != (base[i] if i < len(base) else 0):
+            changes.append(SNAPSHOT_FIELD.pack(i, value))
+    return b"".join(changes)
+
+
+def decode_state_delta(base, length, payload):
+    state = list(base[:length]) + [0] * (length - len(base))
+    for offset in range(0, len(payload), SNAPSHOT_FIELD.size):
+        i, value = SNAPSHOT_FIELD.unpack_from(payload, offset)
+        state[i] = value
+    return tuple(state)
+
+
+# Controllers drive one player each: next_buttons() is called once per frame and returns the
+# button bitmask for the player, jumped() is called when the player started a jump.
+class KeyboardController:
+    """A local player on one set of PLAYER_KEY_BINDINGS."""
+    def __init__(self, input_queue, key_bindings):
+        self.input_queue = input_queue
+        self.key_bindings = key_bindings
+
+    def next_buttons(self):
+        return buttons_from_keys(self.input_queue, *self.key_bindings)
+
+    def jumped(self):
+        self.input_queue.consume(self.key_bindings[2])
+
+
+class AutoplayInput:
+    """Random but human-like button presses, used to drive a player in headless test runs and as bots."""
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.buttons = 0
+        self.frames_left = 0
+
+    def next_buttons(self):
+        if self.frames_left <= 0:
+            self.buttons = self.random.choice((0, 1, 2, 2, 4, 5, 6))
+            self.frames_left = self.random.randint(5, 40)
+        self.frames_left -= 1
+        return self.buttons
+
+    def jumped(self):
+        pass
+
+
+class NetworkHost:
+    def __init__(self, port=NET_PORT):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("", port))
+        self.sock.setblocking(False)
+        self.port = port
+
+        self.host_skin = None
+        self.client_address = None
+        self.client_skin = None
+
+        self.tick = 0
+        self.sent_states = {}
+        self.sent_ticks = deque()
+        self.acked_tick = 0
+
+        self.input_queue = deque()
+        self.last_input_seq = 0
+        self.processed_input_seq = 0
+        self.current_buttons = 0
+
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.packets_dropped = 0
+        self.snapshots_sent = 0
+        self.full_snapshots_sent = 0
+        self.first_snapshot_time = None
+
+    def send(self, packet, address):
+        self.sock.sendto(packet, address)
+        self.bytes_sent += len(packet)
+
+    def receive(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except BlockingIOError:
+                break
+            self.bytes_received += len(data)
+            if not data:
+                continue
+
+            # The socket listens on every interface, a packet that doesn't parse is dropped rather than trusted
+            if data[0] == NET_HELLO and self.client_address in (None, address):
+                try:
+                    client_skin = data[1:].decode()
+                except UnicodeDecodeError:
+                    self.drop_packet(address, "hello not UTF-8")
+                    continue
+                if client_skin.count(":") != 1:
+                    self.drop_packet(address, "hello without type:skin")
+                    continue
+                self.client_address = address
+                self.client_skin = client_skin
+                if self.host_skin:
+                    self.send(bytes([NET_WELCOME]) + self.host_skin.encode(), address)
+
+            elif data[0] == NET_INPUT and address == self.client_address:
+                if len(data) < INPUT_HEADER.size:
+                    self.drop_packet(address, "short input header")
+                    continue
+                _, ack_tick, newest_seq, count = INPUT_HEADER.unpack_from(data)
+                if len(data) < INPUT_HEADER.size + count:
+                    self.drop_packet(address, "input count past the payload")
+                    continue
+                self.acked_tick = max(self.acked_tick, ack_tick)
+                for i in range(count):
+                    seq = newest_seq - count + 1 + i
+                    if seq > self.last_input_seq:
+                        self.input_queue.append((seq, data[INPUT_HEADER.size + i]))
+                        self.last_input_seq = seq
+                while len(self.input_queue) > NET_MAX_QUEUED_INPUTS:
+                    self.input_queue.popleft()
+
+    def drop_packet(self, address, reason):
+        self.packets_dropped += 1
+        event_log.debug("net_packet_dropped", address=address, reason=reason)
+
+    def next_buttons(self):
+        """Controller of the remote player: one queued input is consumed per tick."""
+        if self.input_queue:
+            self.processed_input_seq, self.current_buttons = self.input_queue.popleft()
+        return self.current_buttons
+
+    def jumped(self):
+        pass
+
+    def wait_for_client(self, host_skin, clock):
+        """Shows a waiting screen until a client has joined. Returns the client's (type, skin)."""
+        self.host_skin = host_skin
+        while self.client_skin is None:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    pygame.quit()
+                    exit()
+            self.receive()
+
+            screen.fill(WHITE)
+            waiting_text = menu_font.render(f"Waiting for Player 2 on port {self.port}...", True, BLACK)
+            screen.blit(waiting_text, (WIDTH // 2 - waiting_text.get_width() // 2, HEIGHT // 2))
+            present()
+            clock.tick(30)
+
+        self.send(bytes([NET_WELCOME]) + self.host_skin.encode(), self.client_address)
+        char_type, skin = self.client_skin.split(":")
+        return char_type, skin
+
+    def send_snapshot(self, state):
+        if self.client_address is None:
+            return
+        self.tick += 1
+        base_tick = self.acked_tick if self.acked_tick in self.sent_states else 0
+        base = self.sent_states[base_tick] if base_tick else ()
+
+        packet = SNAPSHOT_HEADER.pack(NET_SNAPSHOT, self.tick, base_tick, self.processed_input_seq, len(state))
+        self.send(packet + encode_state_delta(state, base), self.client_address)
+
+        self.snapshots_sent += 1
+        if not base_tick:
+            self.full_snapshots_sent += 1
+        if self.first_snapshot_time is None:
+            self.first_snapshot_time = time.perf_counter()
+
+        self.sent_states[self.tick] = state
+        self.sent_ticks.append(self.tick)
+        while len(self.sent_ticks) > NET_HISTORY:
+            del self.sent_states[self.sent_ticks.popleft()]
+
+    def report(self):
+        if not self.snapshots_sent:
+            print("Network host: no client connected")
+            return
+        elapsed = max(time.perf_counter() - self.first_snapshot_time, 1e-6)
+        print(f"Network host: {self.bytes_sent / elapsed / 1024:.2f} KB/s to client, "
+              f"{self.bytes_received / elapsed / 1024:.2f} KB/s from client, "
+              f"{self.bytes_sent / self.snapshots_sent:.1f} bytes/snapshot, "
+              f"{self.full_snapshots_sent} of {self.snapshots_sent} snapshots sent in full, "
+              f"{self.packets_dropped} malformed packets dropped")
+
+
+class NetworkClient:
+    def __init__(self, host_address, port=NET_PORT):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.server = (host_address, port)
+
+        self.host_skin = None
+
+        self.input_seq = 0
+        self.pending_inputs = deque(maxlen=NET_MAX_UNACKED_INPUTS)  # (seq, buttons) the host has not processed yet
+        self.input_sent_at = {} # Seq -> send time, oldest first, until a snapshot covers it
+        self.last_processed_input_seq = 0
+
+        self.received_states = {}
+        self.received_ticks = deque()
+        self.latest_tick = 0
+        self.latest_state = None
+
+        self.latencies = deque(maxlen=NET_LATENCY_SAMPLES)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.packets_dropped = 0
+        self.started_at = time.perf_counter()
+
+    def send(self, packet):
+        self.sock.sendto(packet, self.server)
+        self.bytes_sent += len(packet)
+
+    def connect(self, own_skin, clock):
+        """Says hello until the host answers. Returns the host player's (type, skin)."""
+        while self.host_skin is None:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    pygame.quit()
+                    exit()
+            self.send(bytes([NET_HELLO]) + own_skin.encode())
+            self.receive()
+
+            screen.fill(WHITE)
+            joining_text = menu_font.render(f"Joining {self.server[0]}:{self.server[1]}...", True, BLACK)
+            screen.blit(joining_text, (WIDTH // 2 - joining_text.get_width() // 2, HEIGHT // 2))
+            present()
+            clock.tick(10)
+
+        char_type, skin = self.host_skin.split(":")
+        return char_type, skin
+
+    def send_input(self, buttons):
+        self.input_seq += 1
+        self.pending_inputs.append((self.input_seq, buttons))
+        self.input_sent_at[self.input_seq] = time.perf_counter()
+        if len(self.input_sent_at) > NET_MAX_UNACKED_INPUTS:
+            del self.input_sent_at[next(iter(self.input_sent_at))] # The host hasn't answered for a while
+
+        recent = list(self.pending_inputs)[-NET_INPUT_REDUNDANCY:]
+        packet = INPUT_HEADER.pack(NET_INPUT, self.latest_tick, self.input_seq, len(recent))
+        self.send(packet + bytes(recent_buttons for _, recent_buttons in recent))
+
+    def receive(self):
+        """Reads all waiting packets. Returns True if a newer snapshot was decoded."""
+        got_snapshot = False
+        while True:
+            try:
+                data, _ = self.sock.recvfrom(4096)
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                continue
+            self.bytes_received += len(data)
+            if not data:
+                continue
+
+            if data[0] == NET_WELCOME:
+                try:
+                    host_skin = data[1:].decode()
+                except UnicodeDecodeError:
+                    self.packets_dropped += 1
+                    continue
+                if host_skin.count(":") == 1:
+                    self.host_skin = host_skin
+                else:
+                    self.packets_dropped += 1
+
+            elif data[0] == NET_SNAPSHOT:
+                if len(data) < SNAPSHOT_HEADER.size:
+                    self.packets_dropped += 1
+                    continue
+                _, tick, base_tick, processed_seq, length = SNAPSHOT_HEADER.unpack_from(data)
+                if tick <= self.latest_tick or (base_tick and base_tick not in self.received_states):
+                    continue # Out of date, or its base is gone
+                base = self.received_states[base_tick] if base_tick else ()
+                try:
+                    state = decode_state_delta(base, length, data[SNAPSHOT_HEADER.size:])
+                except (struct.error, IndexError):
+                    self.packets_dropped += 1 # A partial field or an index past the state
+                    continue
+
+                self.received_states[tick] = state
+                self.received_ticks.append(tick)
+                while len(self.received_ticks) > NET_HISTORY:
+                    del self.received_states[self.received_ticks.popleft()]
+                self.latest_tick = tick
+                self.latest_state = state
+                got_snapshot = True
+
+                now = time.perf_counter()
+                self.last_processed_input_seq = max(self.last_processed_input_seq, processed_seq)
+                # Inputs the host skipped are covered too, so nothing older than the snapshot stays behind
+                while self.input_sent_at:
+                    seq = next(iter(self.input_sent_at))
+                    if seq > self.last_processed_input_seq:
+                        break
+                    self.latencies.append(now - self.input_sent_at.pop(seq))
+                while self.pending_inputs and self.pending_inputs[0][0] <= self.last_processed_input_seq:
+                    self.pending_inputs.popleft()
+        return got_snapshot
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.started_at, 1e-6)
+        print(f"Network client: {self.bytes_received / elapsed / 1024:.2f} KB/s from host, "
+              f"{self.bytes_sent / elapsed / 1024:.2f} KB/s to host, {self.packets_dropped} malformed packets dropped")
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            average_ms = sum(latencies) / len(latencies) * 1000
+            p95_ms = latencies[int(len(latencies) * 0.95)] * 1000
+            print(f"Network client: input latency avg {average_ms:.1f} ms ({average_ms / (1000 / 60):.1f} frames), "
+                  f"p95 {p95_ms:.1f} ms over {len(latencies)} inputs")
+
+
+
+# Shared State
+# Game can publish a compact record of every tick into a shared memory block, so spectators,
+# dashboards and other tools can follow a game without touching its process. The writer never
+# waits for them: it makes the sequence number odd, writes, and makes it even again (a seqlock).
+# A reader copies the record and keeps it only if the sequence number was even and unchanged.
+STATE_SHM_NAME = os.environ.get("MAZEQUEST_STATE_SHM", "mazequest_state")
+STATE_MAGIC = b"MQS1"
+STATE_MAX_PLAYERS = len(PLAYER_KEY_BINDINGS) + MAX_BOTS
+STATE_MAX_HAZARDS = 1024
+STATE_MAX_TILES = 1 << 16
+STATE_FIELDS = ("frame", "game_state", "level", "retries_left", "timer_ms", "player_count", "human_count", "hazard_count",
+                "tile_size", "world_width", "world_height", "grid_columns", "grid_rows", "grid_revision")
+# One column per value, players first. y_velocity is in sub-pixels per frame, x_velocity in px per frame.
+# Moving hazards are all tile_size x tile_size // 2.
+STATE_PLAYER_COLUMNS = (("x", "i"), ("y", "i"), ("width", "i"), ("height", "i"), ("x_velocity", "i"), ("y_velocity", "i"),
+                        ("on_ground", "b"), ("is_dead", "b"), ("sprite_key", "B"))
+STATE_HAZARD_COLUMNS = (("x", "i"), ("y", "i"))
+
+
+def _shared_state_layout():
+    """Byte offsets in the block: magic at 0, the int32 process id of the publisher at 4, the u64 sequence number at 8, the int32 STATE_FIELDS at 16,
+    then the player and hazard columns (int32 columns first, so all stay aligned), then the tile grid
+    as ASCII rows. Returns ({(group, name): (offset, format, capacity)}, grid offset, block size)."""
+    columns = {}
+    offset = 16 + 4 * len(STATE_FIELDS)
+    for item_format in ("i", "b", "B"):
+        for group, group_columns, capacity in (("players", STATE_PLAYER_COLUMNS, STATE_MAX_PLAYERS),
+                                               ("hazards", STATE_HAZARD_COLUMNS, STATE_MAX_HAZARDS)):
+            for name, column_format in group_columns:
+                if column_format == item_format:
+                    columns[(group, name)] = (offset, column_format, capacity)
+                    offset += capacity * (4 if column_format == "i" else 1)
+    return columns, offset, offset + STATE_MAX_TILES
+
+
+STATE_COLUMNS, STATE_GRID_OFFSET, STATE_SIZE = _shared_state_layout()
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # Exists, but belongs to someone else
+    return True
+
+
+class SharedStatePublisher:
+    """Writes the state of a Game into the shared block once per tick."""
+    names = set() # Blocks published by this process
+
+    def __init__(self, name=STATE_SHM_NAME):
+        try:
+            self.block = shared_memory.SharedMemory(name=name, create=True, size=STATE_SIZE)
+        except FileExistsError:
+            self._reclaim_stale(name)
+            self.block = shared_memory.SharedMemory(name=name, create=True, size=STATE_SIZE)
+        buf = self.block.buf
+        buf[:4] = STATE_MAGIC
+        struct.pack_into("i", buf, 4, os.getpid())
+        self.sequence = buf[8:16].cast("Q")
+        self.fields = buf[16:16 + 4 * len(STATE_FIELDS)].cast("i")
+        self.columns = {key: buf[offset:offset + capacity * (4 if column_format == "i" else 1)].cast(column_format)
+                        for key, (offset, column_format, capacity) in STATE_COLUMNS.items()}
+        self.grid = buf[STATE_GRID_OFFSET:STATE_SIZE]
+        self.grid_key = None # (level, level revision) of the grid in the block
+        self.grid_revision = 0
+        SharedStatePublisher.names.add(name)
+        atexit.register(self.close)
+
+    @staticmethod
+    def _reclaim_stale(name):
+        """Removes a block left behind by a publisher that is gone. Raises FileExistsError if the block belongs to a
+        running game or isn't ours. On Windows a block disappears with its last user, so it is never stale there."""
+        existing = shared_memory.SharedMemory(name=name)
+        ours = bytes(existing.buf[:4]) == STATE_MAGIC
+        owner = struct.unpack_from("i", existing.buf, 4)[0] if ours else 0
+        existing.close()
+        if not ours or os.name == "nt" or owner <= 0 or _process_alive(owner):
+            if name not in SharedStatePublisher.names:
+                # Attaching registered the block for removal when this process exits, it isn't ours to remove
+                resource_tracker.unregister(existing._name, "shared_memory")
+            if not ours:
+                raise FileExistsError(f"shared memory block {name} exists and does not hold MazeQuest state, "
+                                      "choose another name with MAZEQUEST_STATE_SHM")
+            raise FileExistsError(f"shared memory block {name} is in use by process {owner}, "
+                                  "stop that game or choose another name with MAZEQUEST_STATE_SHM")
+        existing.unlink()
+        event_log.warning("stale_state_block_removed", name=name, owner=owner)
+
+    def publish(self, game):
+        level = game.current_level
+        players = game.players[:STATE_MAX_PLAYERS]
+        player_count = len(players)
+        hazard_store = level.moving_hazard_store
+        hazard_count = min(len(hazard_store), STATE_MAX_HAZARDS)
+        store = game.entity_store
+        widths = array("i", [player.rect.width for player in players])
+        heights = array("i", [player.rect.height for player in players])
+        grid_key = (level, level.revision)
+        world_width, world_height = level.get_world_dimensions()
+        columns = self.columns
+
+        self.sequence[0] += 1 # Odd: readers discard what they copy now
+        self.fields[:] = array("i", (game.frame_count, game.game_state, game.level_index + 1, game.retries_left,
+                                     int(game.game_timer.get_elapsed_time() * 1000), player_count, min(game.human_count, player_count),
+                                     hazard_count, level.get_tile_size(), world_width, world_height,
+                                     self.fields[11], self.fields[12], self.grid_revision))
+        for name, items in (("x_velocity", store.x_velocity), ("y_velocity", store.y_velocity), ("on_ground", store.on_ground),
+                            ("is_dead", store.is_dead), ("sprite_key", store.sprite_key)):
+            columns[("players", name)][:player_count] = memoryview(items)[:player_count]
+        columns[("players", "x")][:player_count] = array("i", [player.rect.x for player in players])
+        columns[("players", "y")][:player_count] = array("i", [player.rect.y for player in players])
+        columns[("players", "width")][:player_count] = widths
+        columns[("players", "height")][:player_count] = heights
+        hazard_rects = hazard_store.rects[:hazard_count]
+        columns[("hazards", "x")][:hazard_count] = array("i", [rect.x for rect in hazard_rects])
+        columns[("hazards", "y")][:hazard_count] = array("i", [rect.y for rect in hazard_rects])
+        if grid_key != self.grid_key:
+            # Only when the level changes or is edited
+            self.grid_key = grid_key
+            self.grid_revision += 1
+            grid = "".join(level.tile_grid).encode("ascii")
+            if len(grid) <= STATE_MAX_TILES:
+                self.grid[:len(grid)] = grid
+                self.fields[11], self.fields[12] = level.map_width_tiles, level.map_height_tiles
+            else:
+                self.fields[11] = self.fields[12] = 0
+            self.fields[13] = self.grid_revision
+        self.sequence[0] += 1
+
+    def close(self):
+        if self.block is None:
+            return
+        del self.sequence, self.fields, self.columns, self.grid
+        SharedStatePublisher.names.discard(self.block.name)
+        self.block.close()
+        self.block.unlink()
+        self.block = None
+
+
+class SharedStateReader:
+    """Reads the records of a SharedStatePublisher, possibly in another process. Never blocks the writer."""
+    def __init__(self, name=STATE_SHM_NAME):
+        self.block = shared_memory.SharedMemory(name=name)
+        if name not in SharedStatePublisher.names:
+            # Before Python 3.13, attaching registers the block for removal when this process exits
+            resource_tracker.unregister(self.block._name, "shared_memory")
+        if bytes(self.block.buf[:4]) != STATE_MAGIC:
+            self.block.close()
+            raise ValueError(f"{name} does not hold MazeQuest state")
+        self.sequence = self.block.buf[8:16].cast("Q")
+        self.grid_revision = None
+        self.grid_rows = []
+        self.retries = 0 # Copies thrown away because the writer was busy
+
+    def read(self, attempts=100):
+        """The latest complete record as a dict, or None if every attempt overlapped a write.
+
+        Holds the STATE_FIELDS, "players" and "hazards" ({column: list of values}) and "grid"
+        (the tile rows of the level, only copied when its revision changes)."""
+        buf = self.block.buf
+        for _ in range(attempts):
+            sequence = self.sequence[0]
+            if sequence & 1:
+                self.retries += 1
+                time.sleep(0)
+                continue
+            data = bytes(buf[:STATE_GRID_OFFSET])
+            fields = dict(zip(STATE_FIELDS, struct.unpack_from(f"<{len(STATE_FIELDS)}i", data, 16)))
+            grid = None
+            if fields["grid_revision"] != self.grid_revision:
+                grid = bytes(buf[STATE_GRID_OFFSET:STATE_GRID_OFFSET + fields["grid_columns"] * fields["grid_rows"]])
+            if self.sequence[0] != sequence:
+                self.retries += 1
+                continue
+
+            record = dict(fields, players={}, hazards={})
+            view = memoryview(data)
+            for (group, name), (offset, column_format, capacity) in STATE_COLUMNS.items():
+                count = fields["player_count" if group == "players" else "hazard_count"]
+                record[group][name] = view[offset:offset + capacity * (4 if column_format == "i" else 1)].cast(column_format)[:count].tolist()
+            if grid is not None:
+                columns = fields["grid_columns"]
+                self.grid_rows = [grid[i:i + columns].decode("ascii") for i in range(0, len(grid), columns)] if columns else []
+                self.grid_revision = fields["grid_revision"]
+            record["grid"] = self.grid_rows
+            return record
+        return None
+
+    def close(self):
+        del self.sequence
+        self.block.close()
+
+
+SPECTATOR_TILE_COLORS = {'#': GRAY, 'L': RED, 'W': RED, 'S': RED, 'F': YELLOW, 'D': BROWN}
+
+
+def run_spectator(name=STATE_SHM_NAME, fps=FRAME_RATE, max_frames=None):
+    """A window that follows a game published by another process, with the whole level scaled to fit."""
+    pygame.display.set_caption("MazeQuest Spectator")
+    clock = FramePacer(fps)
+    reader = None
+    tiles = None # (grid revision, pre-drawn tile layer)
+    frame = 0
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+        frame += 1
+        if max_frames and frame >= max_frames:
+            running = False
+        if reader is None:
+            try:
+                reader = SharedStateReader(name)
+            except FileNotFoundError:
+                pass
+        record = reader.read() if reader is not None else None
+        screen.fill(SKY_BLUE)
+        if record is None or not record["world_width"]:
+            waiting_text = game_font.render("Waiting for the game...", True, BLACK)
+            screen.blit(waiting_text, (WIDTH // 2 - waiting_text.get_width() // 2, HEIGHT // 2))
+        else:
+            scale = min(WIDTH / record["world_width"], HEIGHT / record["world_height"])
+            origin_x = (WIDTH - record["world_width"] * scale) / 2
+            origin_y = (HEIGHT - record["world_height"] * scale) / 2
+
+            def to_screen(x, y, width, height):
+                return pygame.Rect(origin_x + x * scale, origin_y + y * scale, max(1, width * scale), max(1, height * scale))
+
+            if tiles is None or tiles[0] != record["grid_revision"]:
+                layer = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
+                tile_size = record["tile_size"]
+                for row_index, row in enumerate(record["grid"]):
+                    for col_index, tile_char in enumerate(row):
+                        color = SPECTATOR_TILE_COLORS.get(tile_char)
+                        if color:
+                            layer.fill(color, to_screen(col_index * tile_size, row_index * tile_size, tile_size, tile_size))
+                tiles = (record["grid_revision"], layer)
+            screen.blit(tiles[1], (0, 0))
+
+            tile_size = record["tile_size"]
+            hazards = record["hazards"]
+            for x, y in zip(hazards["x"], hazards["y"]):
+                screen.fill(PURPLE, to_screen(x, y, tile_size, tile_size // 2))
+            players = record["players"]
+            for i in range(record["player_count"]):
+                color = BLACK if players["is_dead"][i] else (BLUE if i < record["human_count"] else WHITE)
+                screen.fill(color, to_screen(players["x"][i], players["y"][i], players["width"][i], players["height"][i]))
+
+            status = (f"Level {record['level']}  {Timer.format_time_from_seconds(record['timer_ms'] / 1000)}  "
+                      f"Retries {record['retries_left']}  Players {record['human_count']} + {record['player_count'] - record['human_count']} bots  "
+                      f"Frame {record['frame']}")
+            screen.blit(game_font.render(status, True, BLACK), (10, 10))
+        present()
+        clock.tick()
+    if reader is not None:
+        reader.close()
+    pygame.quit()
+
+
+# Batched Physics
+
+class BatchedPhysics:
+    """Advances many independent characters in one level at once with NumPy.
+
+    Gives exactly the results of calling Character.move on every character, including the
+    sprite-dependent rect size, so it can be used for agents and ghost runs by the thousand.
+    Timed doors are solid while the level has them closed; whoever advances the level's clock
+    moves them, as for Character.move.
+    """
+    def __init__(self, level, count, speed=5, jump_strength=JUMP_STRENGTH):
+        if np is None:
+            raise ImportError("BatchedPhysics needs NumPy")
+        self.level = level
+        self.tile_size = level.get_tile_size()
+        self.world_width, self.world_height = level.get_world_dimensions()
+        self.solid = np.array([[tile_char == '#' for tile_char in row] for row in level.tile_grid], dtype=bool)
+        self.door_cells = list(level.doors)
+        self.door_rows = np.array([row for _, row in self.door_cells], dtype=np.int64)
+        self.door_cols = np.array([col for col, _ in self.door_cells], dtype=np.int64)
+        self.speed = speed
+        self.jump_strength = jump_strength
+
+        self.x = np.zeros(count, dtype=np.int64)
+        self.sub_y = np.zeros(count, dtype=np.int64)
+        self.width = np.ones(count, dtype=np.int64)
+        self.height = np.ones(count, dtype=np.int64)
+        self.y_velocity = np.zeros(count, dtype=np.int64)
+        self.on_ground = np.zeros(count, dtype=bool)
+        self.is_dead = np.zeros(count, dtype=bool)
+        self.direction = np.zeros(count, dtype=np.int64)
+        self.moving = np.zeros(count, dtype=bool)
+        self.sprite_key = np.zeros(count, dtype=np.int64)
+        # Width and height of the sprite each character shows for each sprite key
+        self.sprite_sizes = np.ones((count, len(SPRITE_KEYS), 2), dtype=np.int64)
+
+    @classmethod
+    def from_characters(cls, level, characters):
+        physics = cls(level, len(characters), characters[0].speed, characters[0].jump_strength)
+        for i, character in enumerate(characters):
+            physics.set_sprites(i, character.sprites)
+            x, sub_y, y_velocity, on_ground, is_dead, sprite_key = character.get_state()
+            physics.x[i], physics.sub_y[i] = x, sub_y
+            physics.width[i], physics.height[i] = character.rect.size
+            physics.y_velocity[i] = y_velocity
+            physics.on_ground[i] = on_ground
+            physics.is_dead[i] = is_dead
+            physics.direction[i] = DIRECTION_INDEX[character.direction]
+            physics.moving[i] = character.moving
+            physics.sprite_key[i] = sprite_key
+        return physics
+
+    def set_sprites(self, index, sprites):
+        """Takes the sprite sizes of one character, with the same fallbacks as Character.update_sprite."""
+        for key_index, sprite_key in enumerate(SPRITE_KEYS):
+            image = sprites.get(sprite_key, sprites.get(f"{sprite_key[:-1]}P", sprites.get("DownP")))
+            if image.get_width() > self.tile_size or image.get_height() > self.tile_size:
+                raise ValueError("BatchedPhysics needs sprites no larger than a tile")
+            self.sprite_sizes[index, key_index] = image.get_size()
+
+    @property
+    def y(self):
+        return self.sub_y >> SUBPIXEL_BITS
+
+    def get_rect(self, index):
+        return pygame.Rect(int(self.x[index]), int(self.y[index]), int(self.width[index]), int(self.height[index]))
+
+    def _update_doors(self):
+        doors = self.level.doors
+        self.solid[self.door_rows, self.door_cols] = [not doors[cell][2] for cell in self.door_cells]
+
+    def _resolve_collisions(self, x, y, width, height, horizontal, y_velocity=None, on_ground=None):
+        # Characters are never larger than a tile, so at most 2x2 cells can overlap. They are checked
+        # in the same row-major order Character.move walks level.platforms.
+        tile_size = self.tile_size
+        first_col = x // tile_size
+        first_row = y // tile_size
+        rows, cols = self.solid.shape
+        for row_offset in (0, 1):
+            for col_offset in (0, 1):
+                row = first_row + row_offset
+                col = first_col + col_offset
+                inside = (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+                solid = inside & self.solid[np.clip(row, 0, rows - 1), np.clip(col, 0, cols - 1)]
+                tile_x = col * tile_size
+                tile_y = row * tile_size
+                collides = solid & (x < tile_x + tile_size) & (x + width > tile_x) & (y < tile_y + tile_size) & (y + height > tile_y)
+
+                if horizontal:
+                    x = np.where(collides & (x < tile_x), tile_x - width, np.where(collides & (x > tile_x), tile_x + tile_size, x))
+                else:
+                    landing = collides & (y_velocity > 0)
+                    bumping = collides & (y_velocity < 0)
+                    y = np.where(landing, tile_y - height, np.where(bumping, tile_y + tile_size, y))
+                    on_ground = on_ground | landing
+                    y_velocity = np.where(landing | bumping, 0, y_velocity)
+        return x, y, y_velocity, on_ground
+
+    def step(self, left, right, jump, active=None):
+        """One Character.move for every character. left/right/jump are boolean arrays, inactive characters stay put."""
+        left = np.asarray(left, dtype=bool)
+        right = np.asarray(right, dtype=bool) & ~left
+        jump = np.asarray(jump, dtype=bool)
+        if self.door_cells:
+            self._update_doors()
+
+        dx = np.where(left, -self.speed, np.where(right, self.speed, 0))
+        moving = left | right
+        direction = np.where(left, DIRECTION_INDEX["Left"], np.where(right, DIRECTION_INDEX["Right"], self.direction))
+
+        jumping = jump & self.on_ground
+        y_velocity = np.where(jumping, self.jump_strength, self.y_velocity)
+        on_ground = self.on_ground & ~jumping
+        direction = np.where(jumping, DIRECTION_INDEX["Forward"], direction)
+        moving = moving & ~jumping
+
+        y_velocity = np.minimum(y_velocity + GRAVITY, MAX_FALL_SPEED)
+
+        width, height = self.width, self.height
+        x, _, _, _ = self._resolve_collisions(self.x + dx, self.y, width, height, horizontal=True)
+
+        sub_y = self.sub_y + y_velocity
+        y_moved = sub_y >> SUBPIXEL_BITS
+        _, y, y_velocity, on_ground = self._resolve_collisions(x, y_moved, width, height, horizontal=False,
+                                                              y_velocity=y_velocity, on_ground=np.zeros_like(on_ground))
+        sub_y = np.where(y != y_moved, np.where(on_ground, ((y + 1) << SUBPIXEL_BITS) - 1, y << SUBPIXEL_BITS), sub_y)
+        y_velocity = np.where((y_velocity == 0) & ~on_ground, SUBPIXELS, y_velocity)
+
+        x = np.maximum(x, 0)
+        x = np.where(x + width > self.world_width, self.world_width - width, x)
+        is_dead = self.is_dead | (y > self.world_height + 50)
+
+        direction = np.where((dx == 0) & on_ground, DIRECTION_INDEX["Down"], direction)
+        sprite_key = direction * 2 + moving
+
+        # Swap to the new sprite, keeping centerx and bottom like Character.update_sprite
+        new_size = self.sprite_sizes[np.arange(len(sprite_key)), sprite_key]
+        new_width, new_height = new_size[:, 0], new_size[:, 1]
+        x = x + width // 2 - new_width // 2
+        sub_y = sub_y + ((height - new_height) << SUBPIXEL_BITS)
+
+        if active is None:
+            active = np.ones(len(x), dtype=bool)
+        else:
+            active = np.asarray(active, dtype=bool)
+        self.x = np.where(active, x, self.x)
+        self.sub_y = np.where(active, sub_y, self.sub_y)
+        self.width = np.where(active, new_width, self.width)
+        self.height = np.where(active, new_height, self.height)
+        self.y_velocity = np.where(active, y_velocity, self.y_velocity)
+        self.on_ground = np.where(active, on_ground, self.on_ground)
+        self.is_dead = np.where(active, is_dead, self.is_dead)
+        self.direction = np.where(active, direction, self.direction)
+        self.moving = np.where(active, moving, self.moving)
+        self.sprite_key = np.where(active, sprite_key, self.sprite_key)
+
+
+
+# Agent Environment
+# Gym-style reset()/step(action) around Level + Character physics, without Game, menus or drawing.
+# Actions are button bitmasks like in network co-op: 1 = left, 2 = right, 4 = jump.
+ENV_ACTIONS = 8
+OBS_GRID_RADIUS = 3        # The grid window is (2 * radius + 1) tiles wide and high, centred on the player
+OBS_NEAREST_HAZARDS = 2
+OBS_TILE_CODES = {'#': 1, 'L': 2, 'W': 2, 'S': 2, 'M': 0, 'F': 3, 'D': 4} # 'D' is a closed door
+OBS_OPEN_DOOR = 5
+OBS_SIZE = 6 + (2 * OBS_GRID_RADIUS + 1) ** 2 + 2 * OBS_NEAREST_HAZARDS + 2
+
+REWARD_STEP = -0.01
+REWARD_DEATH = -10.0
+REWARD_FINISH = 100.0
+REWARD_PROGRESS = 0.01     # Per pixel the player got closer to the finish line
+
+
+class MazeQuestEnv:
+    def __init__(self, level_map_data, max_steps=2000, retries=3):
+        self.level = Level(level_map_data)
+        self.tile_size = self.level.get_tile_size()
+        world_width, world_height = self.level.get_world_dimensions()
+        self.character = Character("Male", "1", *self.level.get_start_positions()[0], self.tile_size, world_width, world_height)
+        self.max_steps = max_steps
+        self.retries = retries
+        self.steps = 0
+        self.retries_left = retries
+        self.finish_distance = 0
+
+    def distance_to_finish(self):
+        finish = self.level.finish_line.rect
+        return abs(finish.centerx - self.character.rect.centerx) + abs(finish.centery - self.character.rect.centery)
+
+    def reset(self):
+        self.level.reset()
+        self.character.reset_position()
+        self.steps = 0
+        self.retries_left = self.retries
+        self.finish_distance = self.distance_to_finish()
+        return self.observe()
+
+    def step(self, action):
+        """Advances one frame. Returns (observation, reward, done, info)."""
+        self.steps += 1
+        self.level.update()
+        self.character.move(buttons_to_keys(action), 0, 1, 2, self.level.platforms)
+
+        reward = REWARD_STEP
+        done = False
+        info = {}
+        if self.character.handle_hazards(self.level.hazards, self.level.moving_hazards) or self.character.is_dead:
+            reward += REWARD_DEATH
+            info["death"] = True
+            if self.retries_left > 0:
+                self.retries_left -= 1
+                self.character.reset_position()
+            else:
+                done = True
+        elif self.character.rect.colliderect(self.level.finish_line.rect):
+            reward += REWARD_FINISH
+            info["finished"] = True
+            done = True
+
+        distance = self.distance_to_finish()
+        reward += (self.finish_distance - distance) * REWARD_PROGRESS
+        self.finish_distance = distance
+
+        if self.steps >= self.max_steps:
+            done = True
+        return self.observe(), reward, done, info
+
+    def observe(self):
+        """Player rect and motion, the tile grid around the player, nearest moving hazards and the finish line."""
+        rect = self.character.rect
+        obs = array("i", (rect.x, rect.y, rect.width, rect.height,
+                          self.character.y_velocity, int(self.character.on_ground)))
+
+        grid = self.level.tile_grid
+        center_col = rect.centerx // self.tile_size
+        center_row = rect.centery // self.tile_size
+        for row in range(center_row - OBS_GRID_RADIUS, center_row + OBS_GRID_RADIUS + 1):
+            for col in range(center_col - OBS_GRID_RADIUS, center_col + OBS_GRID_RADIUS + 1):
+                if 0 <= row < len(grid) and 0 <= col < len(grid[row]):
+                    tile_char = grid[row][col]
+                    if tile_char == 'D' and self.level.doors[(col, row)][2]:
+                        obs.append(OBS_OPEN_DOOR)
+                    else:
+                        obs.append(OBS_TILE_CODES.get(tile_char, 0))
+                else:
+                    obs.append(1) # Outside the world counts as a wall
+
+        nearest = sorted(self.level.moving_hazards,
+                         key=lambda hazard: abs(hazard.rect.centerx - rect.centerx) + abs(hazard.rect.centery - rect.centery))
+        for i in range(OBS_NEAREST_HAZARDS):
+            if i < len(nearest):
+                obs.extend((nearest[i].rect.centerx - rect.centerx, nearest[i].rect.centery - rect.centery))
+            else:
+                obs.extend((0, 0))
+
+        finish = self.level.finish_line.rect
+        obs.extend((finish.centerx - rect.centerx, finish.centery - rect.centery))
+        return obs
+
+
+def _vector_env_worker(connection, shared_memory_names, first_env, env_count, env_kwargs):
+    blocks = [shared_memory.SharedMemory(name=name) for name in shared_memory_names]
+    observations = blocks[0].buf.cast("i")
+    rewards = blocks[1].buf.cast("d")
+    dones = blocks[2].buf
+    actions = blocks[3].buf
+
+    envs = [MazeQuestEnv(**env_kwargs) for _ in range(env_count)]
+    while True:
+        command = connection.recv()
+        if command == "close":
+            break
+        for i, env in enumerate(envs):
+            env_index = first_env + i
+            if command == "reset":
+                obs, reward, done = env.reset(), 0.0, False
+            else:
+                obs, reward, done, _ = env.step(actions[env_index])
+                if done:
+                    obs = env.reset()
+            observations[env_index * OBS_SIZE:(env_index + 1) * OBS_SIZE] = obs
+            rewards[env_index] = reward
+            dones[env_index] = done
+        connection.send(True)
+
+    del observations, rewards, dones, actions
+    for block in blocks:
+        block.close()
+
+
+class VectorMazeQuestEnv:
+    """Runs num_envs environments in a pool of worker processes.
+
+    Observations, rewards, dones and actions live in shared memory, only a short command goes through the pipes.
+    Finished environments are reset automatically.
+    """
+    def __init__(self, num_envs, num_workers=None, **env_kwargs):
+        self.num_envs = num_envs
+        num_workers = min(num_workers or os.cpu_count() or 1, num_envs)
+
+        sizes = [num_envs * OBS_SIZE * 4, num_envs * 8, num_envs, num_envs]
+        self.blocks = [shared_memory.SharedMemory(create=True, size=size) for size in sizes]
+        self.observations = self.blocks[0].buf.cast("i")
+        self.rewards = self.blocks[1].buf.cast("d")
+        self.dones = self.blocks[2].buf
+        self.actions = self.blocks[3].buf
+
+        # Workers start from a fresh interpreter and must not open a window of their own
+        context = multiprocessing.get_context("spawn")
+        video_driver = os.environ.get("SDL_VIDEODRIVER")
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        self.connections = []
+        self.workers = []
+        try:
+            for worker in range(num_workers):
+                first_env = num_envs * worker // num_workers
+                env_count = num_envs * (worker + 1) // num_workers - first_env
+                parent_connection, child_connection = context.Pipe()
+                process = context.Process(target=_vector_env_worker, daemon=True,
+                                          args=(child_connection, [block.name for block in self.blocks], first_env, env_count, env_kwargs))
+                process.start()
+                self.connections.append(parent_connection)
+                self.workers.append(process)
+        finally:
+            if video_driver is None:
+                del os.environ["SDL_VIDEODRIVER"]
+            else:
+                os.environ["SDL_VIDEODRIVER"] = video_driver
+
+    def _run(self, command):
+        for connection in self.connections:
+            connection.send(command)
+        for connection in self.connections:
+            connection.recv()
+
+    def _results(self):
+        """Copies out of shared memory, so the caller can keep them after the next step and after close()."""
+        if np is not None:
+            return (np.frombuffer(self.observations, dtype=np.int32).reshape(self.num_envs, OBS_SIZE).copy(),
+                    np.frombuffer(self.rewards, dtype=np.float64).copy(),
+                    np.frombuffer(self.dones, dtype=np.bool_).copy())
+        return array("i", self.observations), array("d", self.rewards), bytes(self.dones)
+
+    def reset(self):
+        self._run("reset")
+        return self._results()[0]
+
+    def step(self, actions):
+        """Steps every environment with its action. Returns (observations, rewards, dones)."""
+        for i, action in enumerate(actions):
+            self.actions[i] = action
+        self._run("step")
+        return self._results()
+
+    def close(self):
+        """Stops the workers and frees the shared memory, which is unlinked even if a step went wrong."""
+        try:
+            for connection in self.connections:
+                connection.send("close")
+            for process in self.workers:
+                process.join()
+        finally:
+            self.observations.release()
+            self.rewards.release()
+            del self.observations, self.rewards, self.dones, self.actions
+            for block in self.blocks:
+                try:
+                    block.close()
+                finally:
+                    block.unlink()
+
+
+
+RESPAWN_DELAY = 45 # Ticks from a player's death to the restart, so the death effect can play out
+
 
 class Game:
     def __init__(self):
         self.menu = Menu()
         self.game_state = GAME_STATE_MENU
         self.players = []
+        self.entity_store = EntityStore() # Dynamic state of all players
+        self.particles = ParticleSystem()
+        self.timers = TimerWheel() # Game events, in ticks of the playing state
+        self.pending_respawn = None # TimerEntry of the restart after a death
+        self.quality_level = 0 # Index into QUALITY_LEVELS
+        self.character_broadphase = SweepAndPrune() # Players and bots block each other
+        # HUD text is only rendered again when the shown value changes
+        self.hud_seconds = None
+        self.hud_time_text = None
+        self.hud_retries = None
+        self.hud_retries_text = None
+        self.player_blits = []
         self.mode = None
-        self.player_skins = {"player1": None, "player2": None}
-        self.player_times = {"player1": 0.0, "player2": 0.0} 
+        self.controllers = []  # One per player, see KeyboardController
+        self.player_skins = [] # (type, skin) per player
+        self.player_times = [] # Finish time per player, 0.0 until they finish
+        self.bot_count = 0     # The last bot_count players are bots, they don't count for finishing or retries
         self.retries_left = 3 
 
         self.character_sprites_library = {
@@ -573,224 +3113,780 @@ class Game:
         }
 
         
-        self.level_data = [
-            "________________F__", # Finish 
-            "_____##_______#####", 
-            "___#_____###L__S___", 
-            "#######____________", 
-            "_____###M_____#####", # Movingplatform
-            "####_______________",
-            "_______#####_______", 
-            "_____________L#____", 
-            "_________________#_", 
-            "#####LL#___####LL##",
-            "1_________________2", 
-            "###################"  
+        # Campaign: levels are played in this order
+        self.campaign = [
+            [
+                "________________F__", # Finish 
+                "_____##_______#####", 
+                "___#_____###L__S___", 
+                "#######____________", 
+                "_____###M_____#####", # Movingplatform
+                "####_______________",
+                "_______#####_______", 
+                "_____________L#____", 
+                "_________________#_", 
+                "#####LL#___####LL##",
+                "1_________________2", 
+                "###################"  
+            ],
+            [
+                "F__________________",
+                "___________________",
+                "______####_________",
+                "_##________________",
+                "___________##______",
+                "_____###M__________",
+                "_______________##__",
+                "__________####_____",
+                "_______________##__",
+                "___________________",
+                "1____LL______2_____",
+                "###################"
+            ],
+            [
+                "__________________F",
+                "_______________####",
+                "___________LL______",
+                "________########___",
+                "____M______________",
+                "##########_________",
+                "_____________###___",
+                "________##_________",
+                "___###______M______",
+                "__________#######__",
+                "12____L____________",
+                "###################"
+            ]
         ]
-        
-        self.current_level = Level(self.level_data) 
-        world_width, world_height = self.current_level.get_world_dimensions()
-        
-        self.camera = Camera(WIDTH, HEIGHT, world_width, world_height)
+        # Parallax layers of each campaign level, back to front
+        self.campaign_backgrounds = [
+            ("clouds", "mountains", "hills"),
+            ("clouds", "far_hills", "hills"),
+            ("mountains", "clouds", "far_hills"),
+        ]
+        self.levels = {} # Built levels by campaign index, reused on restarts
+        self.camera = Camera(WIDTH, HEIGHT, 0, 0)
+        self.switch_level(0)
+        self.level_start_snapshot = None
+        self.quick_save = None
+
+        # The next level is built in the background while the "Level Completed" screen is shown
+        self.level_loader = ThreadPoolExecutor(max_workers=1)
+        self.next_level_future = None
+        self.next_level_requested = False # N was pressed before the next level was ready
 
         self.game_timer = Timer()
-        self.clock = pygame.time.Clock()
+        self.clock = FramePacer()
+        self.paused = False
+        self.input_queue = InputQueue(buffered_keys=[jump_key for _, _, jump_key in PLAYER_KEY_BINDINGS])
+
+        # Level editor, toggled with E while playing
+        self.editing = False
+        self.editor_tile = EDITOR_PALETTE[0][0]
+        self.editor_focus = (0, 0) # World position the camera looks at while editing
+        self.level_edited = False
+
+        # Frame times in ms, used to check that level transitions don't cause a spike
+        self.frame_times = deque(maxlen=120)
+        self.frames_since_transition = None
+
+        self.leaderboard = Leaderboard()
+        self.leaderboard_entry = None # Leaderboard entry id of this level's completed run
+        self.level_start_retries = self.retries_left
+
+        # Options set from the command line
+        self.network_host = None
+        self.preset_skin = None # (type, skin) for player 1, skips the skin menu
+        self.local_players = None # Number of local players, asked with the menu if not set
+        self.bots = 0             # Number of bots added after the players
+        self.autoplay = None
+        self.max_frames = None
+        self.frame_count = 0
+        self.profiler = None # The running FrameProfiler session, if any
+        self.profile_frames = PROFILE_FRAMES
+        self.profile_directory = PROFILE_DIR
+        self.state_publisher = None # SharedStatePublisher, set by --publish-state
+
+        # Rendering quality, one of QUALITY_LEVELS. The governor changes it in the playing state, --quality N pins it.
+        self.quality_governor = None
+        if QUALITY_SETTING == "auto":
+            self.quality_governor = QualityGovernor()
+        else:
+            self.set_quality(int(QUALITY_SETTING))
 
     def handle_input(self, event):
         if event.type == pygame.QUIT:
             self.game_state = -1 
+        elif event.type == pygame.KEYDOWN and event.key == PROFILE_KEY and self.profiler is None:
+            self.start_profile()
+
+    @property
+    def human_count(self):
+        return len(self.players) - self.bot_count
+
+    def add_player(self, character_type, skin, controller, bot=False):
+        """Adds a player on the next free spawn point. Bots go after all players."""
+        start_pos = self.current_level.get_start_positions(len(self.players) + 1)[-1]
+        player = Character(character_type, skin, *start_pos, self.current_level.get_tile_size(),
+                           *self.current_level.get_world_dimensions(), self.entity_store)
+        self.players.append(player)
+        self.controllers.append(controller)
+        self.player_skins.append((character_type, skin))
+        self.player_times.append(0.0)
+        self.bot_count += bot
+        return player
+
+    def add_bots(self, count):
+        """Adds scripted players that cycle through the skins, used for load testing."""
+        skins = [(character_type, skin) for character_type, skins in self.character_sprites_library.items() for skin in skins]
+        for i in range(count):
+            self.add_player(*skins[i % len(skins)], AutoplayInput(seed=i), bot=True)
 
     def reset_players_to_start(self):
         """Resets all players to their starting positions and clears their 'dead' status."""
         
-        start1_x, start1_y = self.current_level.get_start_positions()[0]
-        self.players[0].rect.topleft = (start1_x, start1_y)
-        self.players[0].y_velocity = 0
-        self.players[0].on_ground = False
-        self.players[0].is_dead = False
-
-        if len(self.players) > 1:
-            start2_x, start2_y = self.current_level.get_start_positions()[1]
-            self.players[1].rect.topleft = (start2_x, start2_y)
-            self.players[1].y_velocity = 0
-            self.players[1].on_ground = False
-            self.players[1].is_dead = False
-        
-        
-        self.player_times["player1"] = 0.0
-        self.player_times["player2"] = 0.0
+        for i, (player, start_pos) in enumerate(zip(self.players, self.current_level.get_start_positions(len(self.players)))):
+            player.start_pos = start_pos
+            player.reset_position()
+            self.player_times[i] = 0.0
 
     def reset_game(self):
         """Resets the entire game state for a new playthrough."""
         self.players = []
+        self.entity_store = EntityStore()
         self.mode = None
-        self.player_skins = {"player1": None, "player2": None}
-        self.player_times = {"player1": 0.0, "player2": 0.0}
+        self.controllers = []
+        self.player_skins = []
+        self.player_times = []
+        self.bot_count = 0
         self.retries_left = 3
         self.game_timer.stop() 
 
-        self.current_level = Level(self.level_data) 
+        if self.next_level_future:
+            self.next_level_future.cancel()
+            self.next_level_future = None
+        self.next_level_requested = False
+        self.switch_level(0)
+        self.level_start_snapshot = None
+        self.quick_save = None
+
+    def switch_level(self, level_index, level=None):
+        """Makes a campaign level current. Levels are built once and reset when they are entered again."""
+        if level is not None:
+            self.levels[level_index] = level
+        elif level_index not in self.levels:
+            self.levels[level_index] = Level(self.campaign[level_index], background=self.campaign_backgrounds[level_index])
+        self.level_index = level_index
+        self.level_data = self.campaign[level_index]
+        self.current_level = self.levels[level_index]
+        self.current_level.reset()
+        self.particles.clear()
+        self.apply_background_quality(self.current_level)
+
+        world_width, world_height = self.current_level.get_world_dimensions()
+        self.camera.set_level_dimensions(world_width, world_height)
+        for player in self.players:
+            player.world_width = world_width
+            player.world_height = world_height
+
+    def cancel_respawn(self):
+        if self.pending_respawn is not None:
+            self.pending_respawn.cancel()
+            self.pending_respawn = None
+
+    def begin_level(self):
+        """Puts the players on their start points, starts the timer and remembers this state for respawns."""
+        self.cancel_respawn()
+        self.reset_players_to_start()
+        self.game_timer.start()
+        self.paused = False
+        self.editing = False
+        self.input_queue.reset()
+        self.game_state = GAME_STATE_PLAYING
+        self.level_start_snapshot = self.save_snapshot()
+        self.level_start_retries = self.retries_left
+        self.leaderboard_entry = None
+        self.quick_save = None # Belongs to the level it was saved in
+
+    def save_snapshot(self):
+        """Packs the dynamic game state into a small byte buffer."""
+        state = self.get_state()
+        return struct.pack(f"<{len(state)}i", *state)
+
+    def load_snapshot(self, snapshot):
+        """Restores a buffer from save_snapshot() without rebuilding the level."""
+        self.set_state(struct.unpack(f"<{len(snapshot) // 4}i", snapshot))
+
+    def has_next_level(self):
+        return self.level_index + 1 < len(self.campaign)
+
+    def preload_next_level(self):
+        """Starts building the next campaign level on the background worker, unless it was built before."""
+        if self.next_level_future is None and self.has_next_level() and self.level_index + 1 not in self.levels:
+            self.next_level_future = self.level_loader.submit(Level, self.campaign[self.level_index + 1],
+                                                              background=self.campaign_backgrounds[self.level_index + 1])
+
+    def is_next_level_ready(self):
+        """Whether the next level is built, either earlier in this playthrough or by the background worker."""
+        if self.level_index + 1 in self.levels:
+            return True
+        return self.next_level_future is not None and self.next_level_future.done()
+
+    def advance_to_next_level(self):
+        """Switches to the next level and puts the players on its start points. A level played before is reused,
+        with its editor changes, otherwise the preloaded one is taken.
+        Returns False without waiting if the level is still being built, the caller tries again on a later frame."""
+        self.preload_next_level()
+        # Normally already finished while the completion screen was shown
+        if not self.is_next_level_ready():
+            return False
+        next_level = None
+        if self.next_level_future is not None:
+            if self.level_index + 1 not in self.levels:
+                next_level = self.next_level_future.result()
+            self.next_level_future = None
+
+        self.switch_level(self.level_index + 1, next_level)
+        self.begin_level()
+        self.frames_since_transition = 0
+        return True
+
+
+    def get_state(self):
+        respawn_ticks = self.timers.ticks_left(self.pending_respawn) if self.pending_respawn else 0
+        state = [self.game_state, self.level_index, self.retries_left, int(self.game_timer.get_elapsed_time() * 1000),
+                 self.current_level.timers.tick, respawn_ticks]
+        for i, player in enumerate(self.players):
+            x, sub_y, y_velocity, on_ground, is_dead, sprite_key = player.get_state()
+            state += [x, sub_y, y_velocity, int(on_ground), int(is_dead), sprite_key,
+                      int(self.player_times[i] * 1000)]
+        store = self.current_level.moving_hazard_store
+        for i in range(len(store)):
+            state += [store.rects[i].x, store.x_velocity[i]]
+        return tuple(state)
+
+    def check_state(self, state):
+        """Raises ValueError unless state has one entry per player and moving hazard of the current level."""
+        expected = GAME_STATE_HEADER + len(self.players) * GAME_STATE_PLAYER_FIELDS + 2 * len(self.current_level.moving_hazard_store)
+        if len(state) != expected:
+            raise ValueError(f"state of {len(state)} values does not fit {len(self.players)} players and "
+                             f"{len(self.current_level.moving_hazard_store)} moving hazards ({expected} values)")
+
+    def set_state(self, state):
+        """Restores a state from get_state(). A state for another level switches to that level first.
+        Raises ValueError, before changing anything on the same level, if the state does not fit."""
+        if len(state) < GAME_STATE_HEADER:
+            raise ValueError(f"state of {len(state)} values has no header")
+        game_state, level_index, retries_left, timer_ms, level_tick, respawn_ticks = state[:GAME_STATE_HEADER]
+        if level_index != self.level_index:
+            if not 0 <= level_index < len(self.campaign):
+                raise ValueError(f"state of level {level_index + 1} is not in the campaign")
+            self.switch_level(level_index)
+        self.check_state(state)
+        self.retries_left = retries_left
+        self.current_level.set_tick(level_tick)
+        self.cancel_respawn()
+        if respawn_ticks:
+            self.pending_respawn = self.timers.schedule(respawn_ticks, self.respawn)
+        self.game_state = game_state
+        self.game_timer.set_elapsed_time(timer_ms / 1000)
+
+        offset = GAME_STATE_HEADER
+        for i, player in enumerate(self.players):
+            x, sub_y, y_velocity, on_ground, is_dead, sprite_key, finish_ms = state[offset:offset + GAME_STATE_PLAYER_FIELDS]
+            player.set_state((x, sub_y, y_velocity, on_ground, is_dead, sprite_key))
+            self.player_times[i] = finish_ms / 1000
+            offset += GAME_STATE_PLAYER_FIELDS
+
+        store = self.current_level.moving_hazard_store
+        for i in range(len(store)):
+            store.rects[i].x, store.x_velocity[i] = state[offset], state[offset + 1]
+            offset += 2
+
+    def run_network_client(self, client, own_skin):
+        """Runs player 2 of a network co-op game. The host is authoritative, the own player is predicted locally."""
+        host_type, host_skin = client.connect(f"{own_skin[0]}:{own_skin[1]}", self.clock)
+
+        self.mode = "coop"
+        self.add_player(host_type, host_skin, None)
+        own_player = self.add_player(*own_skin, None)
+        self.game_state = GAME_STATE_PLAYING
+
+        running = True
+        while running:
+            frame_start = time.perf_counter()
+            for event in self.input_queue.drain():
+                if event.type == pygame.QUIT:
+                    running = False
+
+            if client.receive():
+                try:
+                    self.set_state(client.latest_state)
+                    state_applied = True
+                except ValueError as error:
+                    event_log.warning("host_state_rejected", reason=str(error))
+                    state_applied = False
+                # Replay the inputs the host hasn't seen yet on top of its authoritative state
+                if state_applied and self.game_state == GAME_STATE_PLAYING and not own_player.is_dead:
+                    for _, pending_buttons in client.pending_inputs:
+                        self.character_broadphase.update(self.players)
+                        own_player.move(buttons_to_keys(pending_buttons), 0, 1, 2, self.current_level.platforms,
+                                        self.character_broadphase.bodies_of(own_player))
+            if self.game_state == -1:
+                running = False
+
+            if self.autoplay:
+                buttons = self.autoplay.next_buttons()
+            else:
+                keys = self.input_queue.sample()
+                buttons = 0
+                for key_bindings in PLAYER_KEY_BINDINGS:
+                    buttons |= buttons_from_keys(keys, *key_bindings)
+            client.send_input(buttons)
+
+            if self.game_state == GAME_STATE_PLAYING:
+                if not own_player.is_dead:
+                    was_on_ground = own_player.on_ground
+                    self.character_broadphase.update(self.players)
+                    own_player.move(buttons_to_keys(buttons), 0, 1, 2, self.current_level.platforms,
+                                    self.character_broadphase.bodies_of(own_player))
+                    if was_on_ground and own_player.y_velocity < 0:
+                        for _, _, jump_key in PLAYER_KEY_BINDINGS:
+                            self.input_queue.consume(jump_key)
+
+                self.camera.follow(self.players)
+                self.draw_playing()
+            else:
+                screen.fill(BLACK if self.game_state == GAME_STATE_GAME_OVER else SKY_BLUE)
+                titles = {GAME_STATE_LEVEL_COMPLETE: "Level Completed!", GAME_STATE_GAME_OVER: "GAME OVER", GAME_STATE_VICTORY: "Victory!"}
+                title_text = large_font.render(titles.get(self.game_state, ""), True, RED if self.game_state == GAME_STATE_GAME_OVER else BLACK)
+                screen.blit(title_text, (WIDTH // 2 - title_text.get_width() // 2, HEIGHT // 2 - 50))
+                waiting_text = game_font.render("Waiting for the host...", True, WHITE if self.game_state == GAME_STATE_GAME_OVER else BLACK)
+                screen.blit(waiting_text, (WIDTH // 2 - waiting_text.get_width() // 2, HEIGHT // 2 + 50))
+
+            present()
+            self.clock.tick()
+            frame_ms = (time.perf_counter() - frame_start) * 1000
+            self.record_frame_time(frame_ms)
+            if self.profiler is not None and self.profiler.end_frame(frame_ms):
+                self.profiler = None
+            self.frame_count += 1
+            event_log.frame = self.frame_count
+            if self.max_frames and self.frame_count >= self.max_frames:
+                running = False
+
+        if self.profiler is not None:
+            self.profiler.stop()
+        client.report()
+        self.clock.report()
+        if frame_capture is not None:
+            frame_capture.close()
+        self.leaderboard.close()
+        pygame.quit()
+
+    def format_rank(self):
+        """Leaderboard rank of the completed run of this level, from the leaderboard's cache."""
+        if self.leaderboard_entry is None:
+            return ""
+        if self.leaderboard.has_failed(self.leaderboard_entry):
+            return " (Rank unavailable)"
+        rank = self.leaderboard.get_rank(self.leaderboard_entry)
+        return f" (Rank #{rank})" if rank else " (Rank ...)"
+
+    def get_run_time(self):
+        """Time of the completed level run: the finish of the last human player."""
+        return max(self.player_times[:self.human_count], default=0.0)
+
+    def start_profile(self):
+        """Profiles the next profile_frames frames, with the level and the players as metadata."""
+        self.profiler = FrameProfiler(self.profile_frames, self.profile_directory, self.describe_for_profile)
+        event_log.info("profile_started", frames=self.profiler.frames, level=self.level_index + 1, players=len(self.players))
+
+    def describe_for_profile(self):
+        return {"frame": self.frame_count, "level": self.level_index + 1, "game_state": self.game_state,
+                "players": len(self.players), "humans": self.human_count, "bots": self.bot_count,
+                "editing": self.editing, "paused": self.paused, "target_fps": self.clock.target_fps}
+
+    def record_frame_time(self, frame_ms):
+        self.frame_times.append(frame_ms)
+
+        # Report the worst frame around a level switch against the normal frame time
+        if self.frames_since_transition is not None:
+            self.frames_since_transition += 1
+            if self.frames_since_transition == 30:
+                recent = list(self.frame_times)[-30:]
+                average_ms = sum(recent) / len(recent)
+                event_log.info("level_transition", level=self.level_index + 1, worst_ms=round(max(recent), 2), average_ms=round(average_ms, 2))
+                self.frames_since_transition = None
+
+    def set_quality(self, level):
+        """Switches to a quality level: particle budget and parallax layers."""
+        particle_budget, _ = QUALITY_LEVELS[level]
+        self.quality_level = level
+        self.particles.spawn_budget = particle_budget
+        self.apply_background_quality(self.current_level)
+
+    def apply_background_quality(self, level):
+        layers = QUALITY_LEVELS[self.quality_level][1]
+        if level.background_layers != layers:
+            level.background_layers = layers
+            level.set_background_size(WIDTH, HEIGHT)
+
+    def observe_frame_quality(self, frame_ms):
+        """Feeds the work time of a playing frame to the governor and applies its decision."""
+        level = self.quality_governor.observe(frame_ms)
+        if level is not None:
+            self.set_quality(level)
+            particle_budget, layers = QUALITY_LEVELS[level]
+            event_log.info("quality_changed", level=level, load=round(self.quality_governor.change_load, 3),
+                           particle_budget=particle_budget, parallax_layers=layers)
+
+    def toggle_editor(self):
+        """Enters or leaves the level editor. The game is frozen while editing and continues in place afterwards."""
+        self.editing = not self.editing
+        self.input_queue.reset()
+        if self.editing:
+            self.game_timer.pause()
+            self.editor_focus = (WIDTH // 2 - self.camera.camera.x, HEIGHT // 2 - self.camera.camera.y)
+            self.level_edited = False
+            return
+
+        if self.level_edited:
+            # Respawns go to the (possibly moved) start points of the edited level
+            player_states = [player.get_state() for player in self.players]
+            self.current_level.reset()
+            self.reset_players_to_start()
+            self.level_start_snapshot = self.save_snapshot()
+            for player, state in zip(self.players, player_states):
+                player.set_state(state)
+            self.free_covered_players()
+            if self.quick_save and len(self.quick_save) != len(self.level_start_snapshot):
+                self.quick_save = None # Saved with a different number of moving hazards
+            event_log.info("level_edited", level=self.level_index + 1, rows=list(self.current_level.tile_grid))
+        if not self.paused:
+            self.game_timer.resume()
+
+    def free_covered_players(self):
+        """After an edit, lifts a player that a painted platform now covers onto its top. A player with no free room
+        there, or covered by a hazard, goes back to the start point instead of dying or sticking in the wall."""
+        level = self.current_level
+        solids = [tile.rect for tile in level.platforms]
+        hazards = [tile.rect for tile in level.hazards] + [hazard.rect for hazard in level.moving_hazards]
+        for i, player in enumerate(self.players):
+            if player.is_dead or (player.rect.collidelist(solids) == -1 and player.rect.collidelist(hazards) == -1):
+                continue
+            lifted = player.rect.copy()
+            for _ in range(3): # A painted column a few tiles high
+                covering = lifted.collidelist(solids)
+                if covering == -1:
+                    break
+                lifted.bottom = solids[covering].top
+            if lifted.top >= 0 and lifted.collidelist(solids) == -1 and lifted.collidelist(hazards) == -1:
+                sprite_key = player.get_state()[5]
+                player.set_state((lifted.x, lifted.y << SUBPIXEL_BITS, 0, False, False, sprite_key))
+            else:
+                player.reset_position()
+            event_log.info("player_uncovered", player=i + 1, x=player.rect.x, y=player.rect.y)
+
+    def editor_cell(self):
+        """Map cell (col, row) under the mouse."""
+        mouse_x, mouse_y = pygame.mouse.get_pos()
+        world_x = mouse_x * WIDTH // window.get_width() - self.camera.camera.x
+        world_y = mouse_y * HEIGHT // window.get_height() - self.camera.camera.y
+        tile_size = self.current_level.get_tile_size()
+        return world_x // tile_size, world_y // tile_size
+
+    def update_editor(self):
+        keys = self.input_queue
         world_width, world_height = self.current_level.get_world_dimensions()
-        self.camera = Camera(WIDTH, HEIGHT, world_width, world_height)
+        focus_x, focus_y = self.editor_focus
+        focus_x += (keys[pygame.K_RIGHT] - keys[pygame.K_LEFT]) * EDITOR_SCROLL_SPEED
+        focus_y += (keys[pygame.K_DOWN] - keys[pygame.K_UP]) * EDITOR_SCROLL_SPEED
+        self.editor_focus = (max(0, min(world_width, focus_x)), max(0, min(world_height, focus_y)))
+        self.camera.center_on(*self.editor_focus)
+
+        buttons = pygame.mouse.get_pressed()
+        if buttons[0] or buttons[2]:
+            col, row = self.editor_cell()
+            if self.current_level.set_tile(col, row, self.editor_tile if buttons[0] else '_'):
+                self.level_edited = True
+
+    def draw_editor(self):
+        self.draw_playing()
+        tile_size = self.current_level.get_tile_size()
+        col, row = self.editor_cell()
+        pygame.draw.rect(screen, WHITE, self.camera.project(pygame.Rect(col * tile_size, row * tile_size, tile_size, tile_size)), 3)
+
+        tile_name = next(name for tile_char, name, _ in EDITOR_PALETTE if tile_char == self.editor_tile)
+        help_text = game_font.render(f"Editing: {tile_name}   1-{len(EDITOR_PALETTE)} tile, left click paint, right click erase, "
+                                     f"arrows scroll, E play", True, BLACK)
+        screen.blit(help_text, (10, HEIGHT - 40))
+
+    def draw_playing(self):
+        """Draws the level, players, particles and HUD. Reuses rects and HUD surfaces, so a frame allocates next to nothing."""
+        self.current_level.draw(screen, self.camera)
+
+        # One [image, screen rect] pair per player, dead players show an empty surface
+        if len(self.player_blits) != len(self.players):
+            self.player_blits = [[EMPTY_SURFACE, pygame.Rect(0, 0, 0, 0)] for _ in self.players]
+        i = 0
+        for player in self.players:
+            entry = self.player_blits[i]
+            i += 1
+            if player.is_dead:
+                entry[0] = EMPTY_SURFACE
+            else:
+                entry[0] = player.image
+                entry[1].update(player.rect)
+                entry[1].move_ip(self.camera.camera.x, self.camera.camera.y)
+        screen.blits(self.player_blits, doreturn=False)
+        self.particles.draw(screen, self.camera)
+
+        seconds = int(self.game_timer.get_elapsed_time())
+        if seconds != self.hud_seconds:
+            self.hud_seconds = seconds
+            self.hud_time_text = game_font.render(f"Time: {Timer.format_time_from_seconds(seconds)}", True, BLACK)
+        screen.blit(self.hud_time_text, (10, 10))
+
+        if self.retries_left != self.hud_retries:
+            self.hud_retries = self.retries_left
+            self.hud_retries_text = game_font.render(f"Retries: {self.retries_left}", True, BLACK)
+        screen.blit(self.hud_retries_text, (10, 50))
+
+    def respawn(self):
+        """Restarts the level some ticks after a player died, or ends the game if no retries are left."""
+        self.pending_respawn = None
+        if self.retries_left > 0:
+            event_log.info("respawn", retries_left=self.retries_left)
+            retries_left = self.retries_left - 1
+            self.load_snapshot(self.level_start_snapshot) 
+            self.retries_left = retries_left
+            self.game_timer.start() 
+        else:
+            event_log.info("game_over", level=self.level_index + 1)
+            self.game_state = GAME_STATE_GAME_OVER
+            self.game_timer.stop() 
+
+    def update_playing(self):
+        """One frame of the playing state: due timers, moving hazards, then every player in one loop, then respawns and finishing."""
+        self.timers.advance()
+        if self.game_state != GAME_STATE_PLAYING:
+            return
+        self.current_level.update() 
 
+        # Sampled as late as possible, right before the physics step
+        self.input_queue.sample()
+        if self.network_host:
+            self.network_host.receive()
+        
+        a_player_hit_hazard_this_frame = False 
+
+        if not self.players:
+            self.game_state = GAME_STATE_MENU 
+
+        # Player Logic
+        human_count = self.human_count
+        level = self.current_level
+        broadphase = self.character_broadphase
+        broadphase.update(self.players)
+        for i, player in enumerate(self.players):
+            buttons = self.controllers[i].next_buttons() # Also for dead players, the network queue moves on every tick
+            if player.is_dead:
+                continue
+
+            was_on_ground = player.on_ground
+            player.move(BUTTON_KEYS[buttons], 0, 1, 2, level.platforms, broadphase.bodies_of(player))
+            if was_on_ground and player.y_velocity < 0:
+                self.controllers[i].jumped()
+                self.particles.emit(*player.rect.midbottom, 8, WHITE, speed=2.0, lifetime=15)
+            if player.handle_hazards(level.hazards, level.moving_hazards):
+                self.particles.emit(*player.rect.center, 48, RED if player.elemental_type == "Fire" else BLUE, speed=6.0, lifetime=45, upward=3.0)
+                if i >= human_count:
+                    player.reset_position() # Bots respawn on their own and don't use up retries
+                    continue
+                event_log.info("hazard_death", player=i + 1, type=player.elemental_type, x=player.rect.x, y=player.rect.y)
+                player.is_dead = True 
+                a_player_hit_hazard_this_frame = True 
+            elif player.is_dead and i >= human_count:
+                player.reset_position() # Fell out of the world
+            
+            if i < human_count and level.finish_line and player.rect.colliderect(level.finish_line.rect) and self.player_times[i] == 0.0:
+                self.player_times[i] = self.game_timer.split()
+                event_log.info("finish", player=i + 1, level=self.level_index + 1, seconds=round(self.player_times[i], 3))
+                self.particles.emit(*player.rect.center, 64, YELLOW, speed=5.0, lifetime=60, upward=4.0)
+        
+        #Hazard Respawn Logic
+        if a_player_hit_hazard_this_frame and self.pending_respawn is None:
+            self.pending_respawn = self.timers.schedule(RESPAWN_DELAY, self.respawn)
+        
+        # Check for level completion (all players reached finish line)
+        all_finished = human_count > 0
+        for i in range(human_count):
+            if self.player_times[i] == 0.0 or self.players[i].is_dead:
+                all_finished = False
+        
+        if all_finished:
+            self.game_timer.stop()
+            # One result per completed run, timed by whoever finished last
+            self.leaderboard_entry = self.leaderboard.record(
+                self.level_index + 1, self.mode,
+                "+".join(f"{player.character_type_for_folder}:{player.skin}" for player in self.players[:human_count]),
+                self.get_run_time(), self.level_start_retries - self.retries_left)
+            if self.has_next_level():
+                self.game_state = GAME_STATE_LEVEL_COMPLETE
+                self.preload_next_level()
+            else:
+                self.game_state = GAME_STATE_VICTORY
 
     def run(self):
         running = True
         while running:
-            for event in pygame.event.get():
+            frame_start = time.perf_counter()
+
+            for event in self.input_queue.drain():
                 self.handle_input(event)
-                if self.game_state in [GAME_STATE_LEVEL_COMPLETE, GAME_STATE_GAME_OVER]:
+                if self.game_state in [GAME_STATE_LEVEL_COMPLETE, GAME_STATE_GAME_OVER, GAME_STATE_VICTORY]:
                     if event.type == pygame.KEYDOWN:
                         if event.key == pygame.K_r: 
                             self.reset_game()
                             self.game_state = GAME_STATE_MENU 
                         elif event.key == pygame.K_q: 
                             running = False
+                        elif event.key == pygame.K_n and self.game_state == GAME_STATE_LEVEL_COMPLETE and self.has_next_level():
+                            self.next_level_requested = not self.advance_to_next_level()
+                elif self.game_state == GAME_STATE_PLAYING and event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_F5:
+                        self.quick_save = self.save_snapshot()
+                        event_log.info("quick_save", size=len(self.quick_save))
+                    elif event.key == pygame.K_e and not self.network_host:
+                        self.toggle_editor()
+                    elif self.editing:
+                        for tile_char, _, key in EDITOR_PALETTE:
+                            if event.key == key:
+                                self.editor_tile = tile_char
+                    elif event.key == pygame.K_F9 and self.quick_save:
+                        try:
+                            self.load_snapshot(self.quick_save)
+                        except ValueError as error:
+                            event_log.warning("quick_save_rejected", reason=str(error))
+                            self.quick_save = None
+                    elif event.key == pygame.K_p and not self.network_host:
+                        self.paused = not self.paused
+                        self.input_queue.reset()
+                        if self.paused:
+                            self.game_timer.pause()
+                        else:
+                            self.game_timer.resume()
 
             if self.game_state == GAME_STATE_MENU:
-                self.mode = self.menu.select_mode()
+                if self.network_host:
+                    self.mode = "coop"
+                elif self.local_players:
+                    self.mode = "solo" if self.local_players == 1 else "coop"
+                else:
+                    self.mode = self.menu.select_mode()
                 self.game_state = GAME_STATE_SELECT_CHAR
 
             elif self.game_state == GAME_STATE_SELECT_CHAR:
-                char_type1, skin1 = self.menu.select_skin(self.character_sprites_library, 1)
-                if char_type1 and skin1:
-                    self.player_skins["player1"] = {"type": char_type1, "skin": skin1}
-                    start1_x, start1_y = self.current_level.get_start_positions()[0]
-                    
-                    self.players.append(Character(char_type1, skin1, start1_x, start1_y, 
-                                                    self.current_level.get_tile_size(), 
-                                                    self.current_level.world_width_pixels, 
-                                                    self.current_level.world_height_pixels))
-                    self.players[0].start_pos = (start1_x, start1_y) 
-
-                    if self.mode == "coop":
-                        char_type2, skin2 = self.menu.select_skin(self.character_sprites_library, 2)
-                        if char_type2 and skin2:
-                            self.player_skins["player2"] = {"type": char_type2, "skin": skin2}
-                            start2_x, start2_y = self.current_level.get_start_positions()[1]
-                            self.players.append(Character(char_type2, skin2, start2_x, start2_y, 
-                                                            self.current_level.get_tile_size(),
-                                                            self.current_level.world_width_pixels, 
-                                                            self.current_level.world_height_pixels))
-                            self.players[1].start_pos = (start2_x, start2_y)
-                        else:
-                            self.players = [] 
-                            self.player_skins = {"player1": None, "player2": None}
-                            self.game_state = GAME_STATE_MENU
-                            print("Player 2 skin selection failed or cancelled. Restarting game mode selection.")
-                            continue 
-                    
-                    self.retries_left = 3 
-                    self.game_state = GAME_STATE_PLAYING
-                    self.game_timer.start() 
+                player_count = self.local_players or (2 if self.mode == "coop" else 1)
+                for player_number in range(1, player_count + 1):
+                    if player_number == 1 and self.preset_skin:
+                        char_type, skin = self.preset_skin
+                    elif player_number == 2 and self.network_host:
+                        char_type, skin = self.network_host.wait_for_client("%s:%s" % self.player_skins[0], self.clock)
+                    else:
+                        char_type, skin = self.menu.select_skin(self.character_sprites_library, player_number)
+                    if not (char_type and skin):
+                        self.reset_game()
+                        self.game_state = GAME_STATE_MENU
+                        event_log.info("skin_selection_cancelled", player=player_number)
+                        break
+
+                    if player_number == 1 and self.autoplay:
+                        controller = self.autoplay
+                    elif player_number == 2 and self.network_host:
+                        controller = self.network_host
+                    else:
+                        controller = KeyboardController(self.input_queue, PLAYER_KEY_BINDINGS[player_number - 1])
+                    self.add_player(char_type, skin, controller)
                 else:
-                    self.game_state = GAME_STATE_MENU
-                    print("Player 1 skin selection failed or cancelled. Returning to main menu.")
+                    self.add_bots(self.bots)
+                    self.retries_left = 3 
+                    self.begin_level()
+
+            elif self.game_state == GAME_STATE_PLAYING and self.editing:
+                self.update_editor()
+                self.draw_editor()
+                present()
+                self.clock.tick()
+
+            elif self.game_state == GAME_STATE_PLAYING and self.paused:
+                self.draw_playing()
+                paused_text = large_font.render("Paused", True, BLACK)
+                screen.blit(paused_text, (WIDTH // 2 - paused_text.get_width() // 2, HEIGHT // 2 - 50))
+                resume_text = game_font.render("Press 'P' to Resume", True, BLACK)
+                screen.blit(resume_text, (WIDTH // 2 - resume_text.get_width() // 2, HEIGHT // 2 + 50))
+                present()
+                self.clock.tick()
 
             elif self.game_state == GAME_STATE_PLAYING:
-                active_player_rects = [p.rect for p in self.players if not p.is_dead]
-                self.camera.update(active_player_rects)
-
-                self.current_level.update() 
+                self.update_playing()
+                self.particles.update()
+                self.camera.follow(self.players, self.human_count) # After the physics step, so this frame shows where the players are now
+                self.draw_playing()
+                present()
+                self.clock.tick() 
 
+            elif self.game_state == GAME_STATE_LEVEL_COMPLETE:
                 screen.fill(SKY_BLUE) 
-                self.current_level.draw(screen, self.camera) 
+                victory_text = large_font.render("Level Completed!", True, BLACK)
+                screen.blit(victory_text, (WIDTH // 2 - victory_text.get_width() // 2, HEIGHT // 2 - 150))
 
-                keys = pygame.key.get_pressed()
-                
-                a_player_hit_hazard_this_frame = False 
-
-                # Player 1 Logic
-                if len(self.players) > 0:
-                    if not self.players[0].is_dead:
-                        self.players[0].move(keys, pygame.K_a, pygame.K_d, pygame.K_w, self.current_level.platforms)
-                        if self.players[0].handle_hazards(self.current_level.hazards, self.current_level.moving_hazards):
-                            print(f"Player 1 ({self.players[0].elemental_type}) hit a lethal hazard!")
-                            self.players[0].is_dead = True 
-                            a_player_hit_hazard_this_frame = True 
-                        
-                        if self.current_level.finish_line and self.players[0].rect.colliderect(self.current_level.finish_line.rect) and self.player_times["player1"] == 0.0:
-                            self.player_times["player1"] = self.game_timer.get_elapsed_time()
-                            print(f"Player 1 finished in: {Timer.format_time_from_seconds(self.player_times['player1'])}")
+                # One line per player, the lines below move down when there are more than two
+                line_y = HEIGHT // 2 - 50
+                for i in range(self.human_count):
+                    time_formatted = Timer.format_time_from_seconds(self.player_times[i])
+                    label = "Your Time" if self.mode == "solo" else f"Player {i + 1} Time"
+                    rank = self.format_rank() if self.human_count == 1 else ""
+                    player_time_text = game_font.render(f"{label}: {time_formatted}{rank}", True, BLACK)
+                    screen.blit(player_time_text, (WIDTH // 2 - player_time_text.get_width() // 2, line_y))
+                    line_y += 50
+                if self.human_count > 1:
+                    run_time_formatted = Timer.format_time_from_seconds(self.get_run_time())
+                    run_time_text = game_font.render(f"Team Time: {run_time_formatted}{self.format_rank()}", True, BLACK)
+                    screen.blit(run_time_text, (WIDTH // 2 - run_time_text.get_width() // 2, line_y))
+                    line_y += 50
+                lines_offset = max(0, line_y - (HEIGHT // 2 + 50))
+
+                if self.next_level_requested and self.advance_to_next_level():
+                    self.next_level_requested = False # N was pressed while loading, the level is ready now
+                if self.is_next_level_ready():
+                    next_text = game_font.render("Press 'N' for the Next Level", True, BLACK)
                 else:
-                    self.game_state = GAME_STATE_MENU 
-
-                # Player 2 Logic
-                if len(self.players) > 1:
-                    if not self.players[1].is_dead:
-                        self.players[1].move(keys, pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, self.current_level.platforms)
-                        if self.players[1].handle_hazards(self.current_level.hazards, self.current_level.moving_hazards):
-                            print(f"Player 2 ({self.players[1].elemental_type}) hit a lethal hazard!")
-                            self.players[1].is_dead = True
-                            a_player_hit_hazard_this_frame = True
-                        
-                        if self.current_level.finish_line and self.players[1].rect.colliderect(self.current_level.finish_line.rect) and self.player_times["player2"] == 0.0:
-                            self.player_times["player2"] = self.game_timer.get_elapsed_time()
-                            print(f"Player 2 finished in: {Timer.format_time_from_seconds(self.player_times['player2'])}")
-                
-                #Hazard Respawn Logic
-                if a_player_hit_hazard_this_frame:
-                    if self.retries_left > 0:
-                        print(f"Respawning all players. Retries left: {self.retries_left}")
-                        self.retries_left -= 1
-                        self.reset_players_to_start() 
-                        self.game_timer.start() 
-                    else:
-                        print("No retries left. Game Over.")
-                        self.game_state = GAME_STATE_GAME_OVER
-                        self.game_timer.stop() 
-                
-                # Check for level completion (all players reached finish line)
-                all_finished = True
-                if self.mode == "solo":
-                    if self.player_times["player1"] == 0.0:
-                        all_finished = False
-                elif self.mode == "coop":
-                    if self.player_times["player1"] == 0.0 or self.player_times["player2"] == 0.0 or self.players[0].is_dead or self.players[1].is_dead:
-                        all_finished = False
-                
-                if all_finished:
-                    self.game_timer.stop()
-                    self.game_state = GAME_STATE_LEVEL_COMPLETE
-                
-                # Draw players 
-                for player in self.players:
-                    if not player.is_dead: 
-                        screen.blit(player.image, self.camera.apply(player))
-
-                # Display HUD 
-                time_text = game_font.render(f"Time: {self.game_timer.format_time()}", True, BLACK)
-                screen.blit(time_text, (10, 10))
-
-                retries_text = game_font.render(f"Retries: {self.retries_left}", True, BLACK)
-                screen.blit(retries_text, (10, 50))
+                    next_text = game_font.render("Loading next level...", True, BLACK)
+                screen.blit(next_text, (WIDTH // 2 - next_text.get_width() // 2, HEIGHT // 2 + 60 + lines_offset))
 
+                instructions_text = game_font.render("Press 'R' to Restart or 'Q' to Quit", True, BLACK)
+                screen.blit(instructions_text, (WIDTH // 2 - instructions_text.get_width() // 2, HEIGHT // 2 + 100 + lines_offset))
+                present()
+                self.clock.tick()
 
-                pygame.display.flip()
-                self.clock.tick(60) 
-
-            elif self.game_state == GAME_STATE_LEVEL_COMPLETE:
-                screen.fill(SKY_BLUE) 
-                victory_text = large_font.render("Level Completed!", True, BLACK)
+            elif self.game_state == GAME_STATE_VICTORY:
+                screen.fill(SKY_BLUE)
+                victory_text = large_font.render("Victory!", True, BLACK)
                 screen.blit(victory_text, (WIDTH // 2 - victory_text.get_width() // 2, HEIGHT // 2 - 150))
 
-                if self.mode == "solo":
-                    time_p1_formatted = Timer.format_time_from_seconds(self.player_times["player1"])
-                    player1_time_text = game_font.render(f"Your Time: {time_p1_formatted}", True, BLACK)
-                    screen.blit(player1_time_text, (WIDTH // 2 - player1_time_text.get_width() // 2, HEIGHT // 2 - 50))
-                elif self.mode == "coop":
-                    time_p1_formatted = Timer.format_time_from_seconds(self.player_times["player1"])
-                    time_p2_formatted = Timer.format_time_from_seconds(self.player_times["player2"])
-                    
-                    player1_time_text = game_font.render(f"Player 1 Time: {time_p1_formatted}", True, BLACK)
-                    player2_time_text = game_font.render(f"Player 2 Time: {time_p2_formatted}", True, BLACK)
-                    
-                    screen.blit(player1_time_text, (WIDTH // 2 - player1_time_text.get_width() // 2, HEIGHT // 2 - 50))
-                    screen.blit(player2_time_text, (WIDTH // 2 - player2_time_text.get_width() // 2, HEIGHT // 2))
+                levels_text = game_font.render(f"All {len(self.campaign)} levels completed", True, BLACK)
+                screen.blit(levels_text, (WIDTH // 2 - levels_text.get_width() // 2, HEIGHT // 2 - 50))
+
+                time_p1_formatted = Timer.format_time_from_seconds(self.get_run_time())
+                player1_time_text = game_font.render(f"Last Level Time: {time_p1_formatted}{self.format_rank()}", True, BLACK)
+                screen.blit(player1_time_text, (WIDTH // 2 - player1_time_text.get_width() // 2, HEIGHT // 2))
 
                 instructions_text = game_font.render("Press 'R' to Restart or 'Q' to Quit", True, BLACK)
                 screen.blit(instructions_text, (WIDTH // 2 - instructions_text.get_width() // 2, HEIGHT // 2 + 100))
-                pygame.display.flip()
+                present()
+                self.clock.tick()
 
             elif self.game_state == GAME_STATE_GAME_OVER:
                 screen.fill(BLACK) 
@@ -799,14 +3895,110 @@ class Game:
                 
                 instructions_text = game_font.render("Press 'R' to Restart or 'Q' to Quit", True, WHITE)
                 screen.blit(instructions_text, (WIDTH // 2 - instructions_text.get_width() // 2, HEIGHT // 2 + 50))
-                pygame.display.flip()
+                present()
+                self.clock.tick()
             
             elif self.game_state == -1: 
                 running = False
 
+            if self.network_host:
+                if self.game_state != GAME_STATE_PLAYING:
+                    self.network_host.receive()
+                self.network_host.send_snapshot(self.get_state())
+
+            frame_ms = (time.perf_counter() - frame_start) * 1000
+            self.record_frame_time(frame_ms)
+            if self.quality_governor is not None and self.game_state == GAME_STATE_PLAYING and not (self.paused or self.editing):
+                self.observe_frame_quality(frame_ms - self.clock.last_wait_ms)
+            if self.profiler is not None and self.profiler.end_frame(frame_ms):
+                self.profiler = None
+            if self.state_publisher is not None:
+                self.state_publisher.publish(self)
+            self.frame_count += 1
+            event_log.frame = self.frame_count
+            if self.max_frames and self.frame_count >= self.max_frames:
+                running = False
+
+        self.level_loader.shutdown(wait=False, cancel_futures=True)
+        if self.profiler is not None:
+            self.profiler.stop() # Quit during a session: keep what was profiled so far
+        if self.state_publisher is not None:
+            self.state_publisher.close()
+        self.leaderboard.close()
+        event_log.close()
+        self.clock.report()
+        if frame_capture is not None:
+            frame_capture.close()
+        if self.network_host:
+            # Tell the client the game is over
+            self.game_state = -1
+            for _ in range(3):
+                self.network_host.send_snapshot(self.get_state())
+            self.network_host.report()
+
         pygame.quit()
         exit()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MazeQuest")
+    parser.add_argument("--host", action="store_true", help="host a network co-op game, the joining player is player 2")
+    parser.add_argument("--join", metavar="ADDRESS", help="join the network co-op game hosted at ADDRESS")
+    parser.add_argument("--port", type=int, default=NET_PORT, help=f"UDP port of the network game (default {NET_PORT})")
+    parser.add_argument("--skin", metavar="TYPE:N", help="skip the skin menu, e.g. Male:1 or Femal:3")
+    parser.add_argument("--autoplay", action="store_true", help="drive the local player with random inputs")
+    parser.add_argument("--players", type=int, choices=range(1, len(PLAYER_KEY_BINDINGS) + 1), metavar=f"1-{len(PLAYER_KEY_BINDINGS)}",
+                        help="number of local players, skips the mode menu")
+    parser.add_argument("--bots", type=int, default=0, choices=range(MAX_BOTS + 1), metavar=f"0-{MAX_BOTS}", help="scripted players for load testing")
+    parser.add_argument("--frames", type=int, help="quit after this many frames")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default=EVENT_LOG_LEVEL, help=f"lowest level written to the event log (default {EVENT_LOG_LEVEL})")
+    parser.add_argument("--fps", type=int, default=FRAME_RATE, help=f"target frame rate (default {FRAME_RATE})")
+    parser.add_argument("--capture", metavar="DIR", help="record the frames into DIR, frames the encoders can't keep up with are dropped")
+    parser.add_argument("--profile", type=int, metavar="N", default=int(os.environ.get("MAZEQUEST_PROFILE", "0")),
+                        help=f"profile the first N frames, F10 then profiles N frames at a time (default: off, F10 profiles {PROFILE_FRAMES})")
+    parser.add_argument("--capture-format", choices=CAPTURE_FORMATS, default="png", help="PNG sequence or a raw RGB24 stream (default png)")
+    parser.add_argument("--publish-state", action="store_true",
+                        help=f"publish every tick to the shared memory block {STATE_SHM_NAME} (MAZEQUEST_STATE_SHM) for spectators and tools")
+    parser.add_argument("--spectate", action="store_true", help="watch a game started with --publish-state on this machine")
+    parser.add_argument("--quality", choices=["auto"] + [str(level) for level in range(len(QUALITY_LEVELS))], default=QUALITY_SETTING,
+                        help=f"rendering quality, 0 is best (default {QUALITY_SETTING}: lowered and raised to hold the frame rate)")
+    args = parser.parse_args()
+    if (args.host or args.join) and (args.players or args.bots):
+        parser.error("--players and --bots are for local games only")
+    if args.spectate:
+        run_spectator(fps=args.fps, max_frames=args.frames)
+        sys.exit()
+
+    event_log.min_level = LOG_LEVELS[args.log_level]
     game = Game()
-    game.run()
\ No newline at end of file
+    game.max_frames = args.frames
+    if args.publish_state:
+        try:
+            game.state_publisher = SharedStatePublisher()
+        except FileExistsError as error:
+            parser.error(str(error))
+    if args.profile:
+        game.profile_frames = args.profile
+        game.start_profile()
+    if args.capture:
+        frame_capture = FrameCapture(args.capture, screen.get_size(), args.fps, args.capture_format)
+    game.local_players = args.players
+    game.bots = args.bots
+    game.clock.target_fps = args.fps
+    if args.quality == "auto":
+        game.quality_governor = QualityGovernor(1000 / args.fps, game.quality_level)
+    else:
+        game.quality_governor = None
+        game.set_quality(int(args.quality))
+    if args.autoplay:
+        game.autoplay = AutoplayInput()
+    if args.skin:
+        game.preset_skin = tuple(args.skin.split(":"))
+
+    if args.join:
+        own_skin = game.preset_skin or game.menu.select_skin(game.character_sprites_library, 2)
+        if own_skin[0]:
+            game.run_network_client(NetworkClient(args.join, args.port), own_skin)
+    else:
+        if args.host:
+            game.network_host = NetworkHost(args.port)
+        game.run()
\ No newline at end of file